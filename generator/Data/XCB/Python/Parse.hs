@@ -1,17 +1,20 @@
 {-# LANGUAGE ViewPatterns #-}
 module Data.XCB.Python.Parse (
   parse,
+  Backend(..),
   xform,
+  xformWith,
+  headerImports,
   renderPy
   ) where
 
 import Control.Monad.State.Strict
 
+import Data.Char (isDigit)
 import Data.Either
 import Data.List
 import Data.List.Utils
 import qualified Data.Map as M
-import Data.Tree
 import Data.Maybe
 import Data.XCB.FromXML
 import Data.XCB.Types as X
@@ -35,6 +38,14 @@ data TypeInfo =
 
 type TypeInfoMap = M.Map X.Type TypeInfo
 
+-- | How to generate the bindings. Classic emits an __init__ (and pack) method
+-- for every struct, event, error and reply and a method for every request;
+-- Tables emits a field table for each of them instead, which the runtime in
+-- xcffib interprets. Tables makes for much smaller modules which are faster
+-- to import, at some cost in decoding speed.
+data Backend = Classic | Tables
+  deriving (Eq, Show)
+
 data BindingPart =
   Request (Statement ()) (Suite ()) |
   Declaration (Suite ()) |
@@ -57,18 +68,30 @@ parse fp = do
 renderPy :: Suite () -> String
 renderPy s = ((intercalate "\n") $ map prettyText s) ++ "\n"
 
--- | Generate the code for a set of X headers. Note that the code is generated
--- in dependency order, NOT in the order you pass them in. Thus, you get a
--- string (a suggested filename) along with the python code for that XHeader
--- back.
+-- | Generate the code for a set of X headers. You get a string (a suggested
+-- filename) along with the python code for each XHeader back, in the order
+-- you passed them in.
 xform :: [XHeader] -> [(String, Suite ())]
-xform = map buildPython . dependencyOrder
+xform = xformWith Classic
+
+-- | xform, with a choice of backend.
+xformWith :: Backend -> [XHeader] -> [(String, Suite ())]
+xformWith backend headers = map (snd . (results M.!) . xheader_header) headers
   where
-    buildPython :: Tree XHeader -> (String, Suite ())
-    buildPython forest =
-      let forest' = (mapM processXHeader $ postOrder forest)
-          results = evalState forest' baseTypeInfo
-      in last results
+    headerM = M.fromList $ map (\h -> (xheader_header h, h)) headers
+    -- Each header is processed exactly once, starting from the TypeInfoMaps
+    -- its imports ended up with (so typedefs are propogated appropriately).
+    -- This relies on the map being lazy: a header's entry is only computed
+    -- when something asks for it, and then only once, no matter how many
+    -- headers import it.
+    results :: M.Map String (TypeInfoMap, (String, Suite ()))
+    results = M.map build headerM
+    build :: XHeader -> (TypeInfoMap, (String, Suite ()))
+    build header =
+      let imported = map (fst . (results M.!)) $ headerImports header
+          start = M.unions $ imported ++ [baseTypeInfo]
+          (out, m) = runState (processXHeader header) start
+      in (m, out)
     processXHeader :: XHeader
                    -> State TypeInfoMap (String, Suite ())
     processXHeader header = do
@@ -78,27 +101,20 @@ xform = map buildPython . dependencyOrder
           globals = [mkDict "_events", mkDict "_errors"]
           name = xheader_header header
           add = [mkAddExt header]
-      parts <- mapM (processXDecl name) $ xheader_decls header
+      parts <- mapM (processXDecl backend name) $ xheader_decls header
       let (requests, decls) = collectBindings parts
           ext = if length requests > 0
                 then [mkClass (name ++ "Extension") "xcffib.Extension" requests]
                 else []
       return $ (name, concat [imports, version, key, globals, decls, ext, add])
-    -- Rearrange the headers in dependency order for processing (i.e. put
-    -- modules which import others after the modules they import, so typedefs
-    -- are propogated appropriately).
-    dependencyOrder :: [XHeader] -> Forest XHeader
-    dependencyOrder headers = unfoldForest unfold $ map xheader_header headers
-      where
-        headerM = M.fromList $ map (\h -> (xheader_header h, h)) headers
-        unfold s = let h = headerM M.! s in (h, deps h)
-        deps :: XHeader -> [String]
-        deps = catMaybes . map matchImport . xheader_decls
-        matchImport :: XDecl -> Maybe String
-        matchImport (XImport n) = Just n
-        matchImport _ = Nothing
-    postOrder :: Tree a -> [a]
-    postOrder (Node e cs) = (concat $ map postOrder cs) ++ [e]
+
+-- | The names of the headers a header imports.
+headerImports :: XHeader -> [String]
+headerImports = catMaybes . map matchImport . xheader_decls
+  where
+    matchImport :: XDecl -> Maybe String
+    matchImport (XImport n) = Just n
+    matchImport _ = Nothing
 
 
 mkAddExt :: XHeader -> Statement ()
@@ -147,7 +163,8 @@ xBinopToPyOp :: X.Binop -> P.Op ()
 xBinopToPyOp X.Add = P.Plus ()
 xBinopToPyOp X.Sub = P.Minus ()
 xBinopToPyOp X.Mult = P.Multiply ()
-xBinopToPyOp X.Div = P.Divide ()
+-- X expressions are integer arithmetic, so make sure python 3 agrees.
+xBinopToPyOp X.Div = P.FloorDivide ()
 xBinopToPyOp X.And = P.BinaryAnd ()
 xBinopToPyOp X.RShift = P.ShiftRight ()
 
@@ -203,6 +220,23 @@ mkPad :: Int -> String
 mkPad 1 = "x"
 mkPad i = (show i) ++ "x"
 
+-- | The size of a pack string, like python's struct.calcsize with no
+-- alignment (i.e. with a "=" prefix).
+calcsize :: String -> Int
+calcsize [] = 0
+calcsize s =
+  let (count, rest) = span isDigit s
+      n = if null count then 1 else read count
+  in case rest of
+       (c : rest') -> n * charSize c + calcsize rest'
+       [] -> error $ "Bad pack string " ++ s
+  where
+    charSize c | c `elem` "xcbB" = 1
+               | c `elem` "hH" = 2
+               | c `elem` "iIf" = 4
+               | c `elem` "qQd" = 8
+               | otherwise = error $ "Unknown pack type " ++ [c]
+
 structElemToPyUnpack :: String
                      -> TypeInfoMap
                      -> GenStructElem Type
@@ -313,25 +347,24 @@ mkPackStmts ext name m accessor prefix membs =
       lists' = map (flip StmtExpr () . mkCall "buf.write" . (: [])) lists
       (args, keys) = unzip toPack
       args' = catMaybes args
-      methodArgs =
-        let theArgs = args' ++ listNames
-        in case (ext, name) of
-             -- XXX: The 1.10 ConfigureWindow definiton has value_mask
-             -- explicitly listed in the protocol definition, but everywhere
-             -- else it isn't; to keep things uniform, we remove it here.
-             ("xproto", "ConfigureWindow") -> nub $ theArgs
-             -- XXX: QueryTextExtents has a field named "odd_length" with a
-             -- fieldref of "string_len", so we fix it up here to match.
-             ("xproto", "QueryTextExtents") -> replace ["odd_length"]
-                                                       ["string_len"]
-                                                       theArgs
-             _ -> theArgs
+      methodArgs = fixupArgs ext name $ args' ++ listNames
       packStr = addStructData prefix $ intercalate "" keys
       write = mkCall "buf.write" [mkCall "struct.pack"
                                          (mkStr ('=' : packStr) : (map mkName args'))]
       writeStmt = if length packStr > 0 then [StmtExpr write ()] else []
   in (methodArgs, buf ++ writeStmt ++ lists')
 
+fixupArgs :: String -> String -> [String] -> [String]
+-- XXX: The 1.10 ConfigureWindow definiton has value_mask explicitly listed in
+-- the protocol definition, but everywhere else it isn't; to keep things
+-- uniform, we remove it here.
+fixupArgs "xproto" "ConfigureWindow" theArgs = nub theArgs
+-- XXX: QueryTextExtents has a field named "odd_length" with a fieldref of
+-- "string_len", so we fix it up here to match.
+fixupArgs "xproto" "QueryTextExtents" theArgs =
+  replace ["odd_length"] ["string_len"] theArgs
+fixupArgs _ _ theArgs = theArgs
+
 mkPackMethod :: String
              -> String
              -> TypeInfoMap
@@ -343,6 +376,47 @@ mkPackMethod ext name m structElems =
       ret = [mkReturn $ mkCall "buf.getvalue" noArgs]
   in mkMethod "pack" (mkParams ["self"]) $ packStmts ++ ret
 
+-- | The pack method of an event, for sending it with SendEvent. The base type
+-- fields (and the response type, in place of the first pad byte) are packed
+-- with a Struct built when the module is loaded; when there is nothing else,
+-- it is padded out to the 32 bytes of an event, so packing is a single call.
+mkEventPack :: String
+            -> String
+            -> TypeInfoMap
+            -> [GenStructElem Type]
+            -> Suite ()
+mkEventPack prefix ext m membs =
+  let packF = structElemToPyPack ext m ((++) "self.")
+      (toPack, extras) = partitionEithers $ map packF membs
+      (args, keys) = unzip toPack
+      -- Every event's pack string starts with the response type's pad byte.
+      packStr = 'B' : (tail $ addStructData prefix $ concat keys)
+      size = calcsize packStr
+      packStr' = if null extras && size < 32
+                 then packStr ++ mkPad (32 - size)
+                 else packStr
+      packer = mkAssign "_pack_struct" $
+                 mkCall "struct.Struct" [mkStr ('=' : packStr')]
+      packed = mkCall "self._pack_struct.pack" $
+                 map mkName ("self.response_type" : catMaybes args)
+      plus a b = BinaryOp (Plus ()) a b ()
+      ret = if null extras
+            then packed
+            else mkCall "xcffib.pad_event" [foldl plus packed $ map snd extras]
+  in [packer, mkMethod "pack" (mkParams ["self"]) [mkReturn ret]]
+
+-- | The pack method of a union; see xcffib.pack_union.
+mkUnionPack :: String -> TypeInfoMap -> [GenStructElem Type] -> Statement ()
+mkUnionPack ext m membs =
+  let member (SField n typ _ _) =
+        Just $ mkList [mkStr $ pyIdent n, mkTypeRef ext m typ]
+      member (X.List n typ _ _) =
+        Just $ mkList [mkStr $ pyIdent n, mkTypeRef ext m typ, pyNone]
+      member _ = Nothing
+      members = mkList $ mapMaybe member membs
+      ret = mkReturn $ mkCall "xcffib.pack_union" [mkName "self", members]
+  in mkMethod "pack" (mkParams ["self"]) [ret]
+
 -- | Make a struct style (i.e. not union style) unpack.
 mkStructStyleUnpack :: String
                     -> String
@@ -368,6 +442,92 @@ mkStructStyleUnpack prefix ext m membs =
       statements = base ++ baseTUnpack ++ lists ++ bufsize
   in statements
 
+-- | A reference to a type from a field table: its format string if it is a
+-- base type, or its class.
+mkTypeRef :: String -> TypeInfoMap -> X.Type -> Expr ()
+mkTypeRef ext m typ =
+  case m M.! typ of
+    BaseType c -> mkStr c
+    CompositeType tExt c | ext /= tExt -> mkName $ tExt ++ "." ++ c
+    CompositeType _ c -> mkName c
+
+-- | Like structElemToPyUnpack, but for a field table (see _unpack_fields in
+-- xcffib).
+structElemToTableEntry :: String
+                       -> TypeInfoMap
+                       -> GenStructElem Type
+                       -> Either (Maybe String, String) (Expr ())
+structElemToTableEntry ext m (X.List n typ len _) =
+  let len' = maybe pyNone (mkLambda "s" . xExpressionToPyExpr ((++) "s.")) len
+  in Right $ mkList [mkStr $ pyIdent n, mkTypeRef ext m typ, len']
+structElemToTableEntry ext m (SField n typ _ _)
+  | CompositeType _ _ <- m M.! typ =
+    Right $ mkList [mkStr $ pyIdent n, mkTypeRef ext m typ]
+structElemToTableEntry ext m x = tableBase $ structElemToPyUnpack ext m x
+
+tableBase :: Either (Maybe String, String) a -> Either (Maybe String, String) b
+tableBase (Left (n, c)) = Left (fmap pyIdent n, c)
+tableBase (Right _) = error "Not a base type field"
+
+-- | The field table of a struct, event, error or reply; the table driven
+-- equivalent of mkStructStyleUnpack (and mkPackMethod).
+mkFieldTable :: String
+             -> String
+             -> TypeInfoMap
+             -> [GenStructElem Type]
+             -> Expr ()
+mkFieldTable prefix ext m membs =
+  let (toUnpack, extras) = partitionEithers $ map (structElemToTableEntry ext m) membs
+      (names, packs) = unzip toUnpack
+      packs' = case prefix of
+                 "" -> concat packs
+                 _ -> addStructData prefix $ concat packs
+      names' = catMaybes names
+  in mkList [mkStr packs', mkList (map mkStr names'), mkList extras]
+
+-- | The field table of a union: every member is an "extra", since they all
+-- start at the beginning of the union.
+mkUnionTable :: String -> TypeInfoMap -> [GenStructElem Type] -> Expr ()
+mkUnionTable ext m membs =
+  let member (SField n typ _ _) | BaseType c <- m M.! typ =
+        Just $ mkList [mkStr $ pyIdent n, mkStr c]
+      member x = either (const Nothing) Just $ structElemToTableEntry ext m x
+  in mkList [mkStr "", mkList [], mkList $ mapMaybe member membs]
+
+mkTableClass :: String -> String -> Expr () -> Statement ()
+mkTableClass name superclazz table =
+  mkClass name superclazz [mkAssign "_fields" table]
+
+-- | Like structElemToPyPack, for a request table (see xcffib.request_method).
+structElemToRequestEntry :: String
+                         -> TypeInfoMap
+                         -> GenStructElem Type
+                         -> Either (Maybe String, String) ([String], Expr ())
+structElemToRequestEntry _ m (SField n typ _ _)
+  | CompositeType _ _ <- m M.! typ =
+    Right ([n], mkList [mkStr "struct", mkStr $ pyIdent n])
+structElemToRequestEntry ext m (X.List n typ _ _) =
+  Right ([n], mkList [mkStr "list", mkStr $ pyIdent n, mkTypeRef ext m typ])
+structElemToRequestEntry _ m (ExprField name typ expr) =
+  let fmt = case m M.! typ of
+              BaseType c -> mkStr c
+              CompositeType _ _ -> pyNone
+      e = mkLambda "a" $ xExpressionToPyExpr ((++) "a.") expr
+  in Right ([name], mkList [mkStr "expr", fmt, e])
+structElemToRequestEntry _ m (ValueParam typ mask _ list) =
+  case m M.! typ of
+    BaseType c -> Right ([mask, list], mkList [ mkStr "valueparam"
+                                              , mkStr c
+                                              , mkStr $ pyIdent mask
+                                              , mkStr $ pyIdent list
+                                              ])
+    CompositeType _ _ -> error (
+      "ValueParams other than CARD{16,32} not allowed.")
+structElemToRequestEntry ext m x =
+  case structElemToPyPack ext m id x of
+    Left (n, c) -> Left (fmap pyIdent n, c)
+    Right _ -> error "Not a base type field"
+
 -- | Given a (qualified) type name and a target type, generate a TypeInfoMap
 -- updater.
 mkModify :: String -> String -> TypeInfo -> TypeInfoMap -> TypeInfoMap
@@ -377,46 +537,83 @@ mkModify ext name ti m =
                       ]
   in M.union m m'
 
-processXDecl :: String
+processXDecl :: Backend
+             -> String
              -> XDecl
              -> State TypeInfoMap BindingPart
-processXDecl ext (XTypeDef name typ) =
+processXDecl _ ext (XTypeDef name typ) =
   do modify $ \m -> mkModify ext name (m M.! typ) m
      return Noop
-processXDecl ext (XidType name) =
+processXDecl _ ext (XidType name) =
   -- http://www.markwitmer.com/guile-xcb/doc/guile-xcb/XIDs.html
   do modify $ mkModify ext name (BaseType "I")
      return Noop
-processXDecl _ (XImport n) =
+processXDecl _ _ (XImport n) =
   return $ Declaration [mkImport n]
-processXDecl _ (XEnum name membs) =
+processXDecl _ _ (XEnum name membs) =
   return $ Declaration [mkEnum name $ xEnumElemsToPyEnum id membs]
-processXDecl ext (XStruct n membs) = do
+processXDecl Tables ext (XStruct n membs) = do
+  m <- get
+  modify $ mkModify ext n (CompositeType ext n)
+  return $ Declaration [mkTableClass n "xcffib.Struct" $ mkFieldTable "" ext m membs]
+processXDecl Classic ext (XStruct n membs) = do
   m <- get
   let statements = mkStructStyleUnpack "" ext m membs
       pack = mkPackMethod ext n m membs
   modify $ mkModify ext n (CompositeType ext n)
   return $ Declaration [mkXClass n "xcffib.Struct" statements [pack]]
-processXDecl ext (XEvent name number membs noSequence) = do
+processXDecl backend ext (XEvent name number membs noSequence) = do
   m <- get
   let cname = name ++ "Event"
       prefix = if fromMaybe False noSequence then "x" else "x{0}2x"
-      statements = mkStructStyleUnpack prefix ext m membs
+      theEvent = case backend of
+        Classic -> mkXClass cname "xcffib.Event" (mkStructStyleUnpack prefix ext m membs)
+                            (mkEventPack prefix ext m membs)
+        Tables -> mkTableClass cname "xcffib.Event" $ mkFieldTable prefix ext m membs
       eventsUpd = mkDictUpdate "_events" number cname
-  return $ Declaration [ mkXClass cname "xcffib.Event" statements []
+  return $ Declaration [ theEvent
                        , eventsUpd
                        ]
-processXDecl ext (XError name number membs) = do
+processXDecl backend ext (XError name number membs) = do
   m <- get
   let cname = name ++ "Error"
-      statements = mkStructStyleUnpack "xx2x" ext m membs
+      theError = case backend of
+        Classic -> mkXClass cname "xcffib.Error" (mkStructStyleUnpack "xx2x" ext m membs) []
+        Tables -> mkTableClass cname "xcffib.Error" $ mkFieldTable "xx2x" ext m membs
       errorsUpd = mkDictUpdate "_errors" number cname
       alias = mkAssign ("Bad" ++ name) (mkName cname)
-  return $ Declaration [ mkXClass cname "xcffib.Error" statements []
+  return $ Declaration [ theError
                        , alias
                        , errorsUpd
                        ]
-processXDecl ext (XRequest name number membs reply) = do
+processXDecl Tables ext (XRequest name number membs reply) = do
+  m <- get
+  let (toPack, extras) = partitionEithers $ map (structElemToRequestEntry ext m) membs
+      (listNames, extras') = let (lns, es) = unzip extras in (concat lns, es)
+      (args, keys) = unzip toPack
+      args' = catMaybes args
+      methodArgs = map pyIdent $ fixupArgs ext name $ args' ++ listNames
+      packStr = addStructData "x{0}2x" $ intercalate "" keys
+      cookieName = (name ++ "Cookie")
+      replyDecl = concat $ maybeToList $ do
+        reply' <- reply
+        let replyName = name ++ "Reply"
+            theReply = mkTableClass replyName "xcffib.Reply" $
+                         mkFieldTable "x{0}2x4x" ext m reply'
+            replyType = mkAssign "reply_type" $ mkName replyName
+            cookie = mkClass cookieName "xcffib.Cookie" [replyType]
+        return [theReply, cookie]
+      cookieArg = if isJust reply then mkName cookieName else pyNone
+      request = mkCall "xcffib.request_method" [ mkInt number
+                                               , mkList $ map mkStr methodArgs
+                                               , mkStr packStr
+                                               , mkList $ map mkStr args'
+                                               , mkList extras'
+                                               , cookieArg
+                                               , pyTruth $ isJust reply
+                                               ]
+  return $ Request (mkAssign name request) replyDecl
+processXDecl Classic ext (XRequest name number membs reply) = do
   m <- get
   let (args, packStmts) = mkPackStmts ext name m id "x{0}2x" membs
       cookieName = (name ++ "Cookie")
@@ -445,13 +642,21 @@ processXDecl ext (XRequest name number membs reply) = do
       requestBody = packStmts ++ [ret]
       request = mkMethod name allArgs requestBody
   return $ Request request replyDecl
-processXDecl ext (XUnion name membs) = do
+processXDecl Tables ext (XUnion name membs) = do
+  m <- get
+  modify $ mkModify ext name (CompositeType ext name)
+  return $ Declaration [mkTableClass name "xcffib.Union" $ mkUnionTable ext m membs]
+processXDecl Classic ext (XUnion name membs) = do
   m <- get
   let unpackF = structElemToPyUnpack ext m
       (fields, lists) = partitionEithers $ map unpackF membs
       toUnpack = map mkUnionUnpack fields
-      initMethod = lists ++ toUnpack
-      decl = [mkXClass name "xcffib.Union" initMethod []]
+      -- All the members start at the beginning of the union.
+      base = mkAssign "base" $ mkName "unpacker.offset"
+      rewind = mkAssign "unpacker.offset" $ mkName "base"
+      members = lists ++ toUnpack
+      initMethod = if null members then [] else base : intersperse rewind members
+      decl = [mkXClass name "xcffib.Union" initMethod [mkUnionPack ext m membs]]
   modify $ mkModify ext name (CompositeType ext name)
   return $ Declaration decl
   where
@@ -460,7 +665,7 @@ processXDecl ext (XUnion name membs) = do
     mkUnionUnpack (n, typ) =
       mkUnpackFrom (maybeToList n) typ False
 
-processXDecl ext (XidUnion name _) =
+processXDecl _ ext (XidUnion name _) =
   -- These are always unions of only XIDs.
   do modify $ mkModify ext name (BaseType "I")
      return Noop
@@ -14,6 +14,8 @@ module Data.XCB.Python.PyHelpers (
   mkEmptyClass,
   mkXClass,
   mkStr,
+  mkList,
+  mkLambda,
   mkUnpackFrom,
   mkDict,
   mkDictUpdate,
@@ -22,6 +24,7 @@ module Data.XCB.Python.PyHelpers (
   pyTruth,
   mkParams,
   ident,
+  pyIdent,
   pyNone
   ) where
 
@@ -48,6 +51,11 @@ ident s | isInt s = Ident ("_" ++ s) ()
     maybeRead = fmap fst . listToMaybe . reads
 ident s = Ident s ()
 
+-- | The string form of a sanatized identifier, e.g. for use as an attribute
+-- name in a string.
+pyIdent :: String -> String
+pyIdent = ident_string . ident
+
 -- Make a DottedName out of a string like "foo.bar" for use in imports.
 mkDottedName :: String -> DottedName ()
 mkDottedName = map ident . splitOn "."
@@ -135,6 +143,13 @@ mkStr s = Strings ["\"", s, "\""] ()
 mkTuple :: [Expr ()] -> Expr ()
 mkTuple = flip Tuple ()
 
+mkList :: [Expr ()] -> Expr ()
+mkList = flip List ()
+
+-- | A one argument lambda, i.e. lambda <arg>: <body>.
+mkLambda :: String -> Expr () -> Expr ()
+mkLambda arg body = Lambda (mkParams [arg]) body ()
+
 mkUnpackFrom :: [String] -> String -> Bool -> Statement ()
 mkUnpackFrom names packs isUnion =
   let lhs = mkTuple $ map mkAttr names
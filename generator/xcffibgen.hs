@@ -1,15 +1,27 @@
 module Main where
 
+import Control.Monad
+import Control.Parallel.Strategies
+
+import qualified Data.ByteString.Lazy as BS
+import qualified Data.ByteString.Lazy.Char8 as BSC
+import Data.Digest.Pure.MD5
+import Data.List
+import qualified Data.Map as M
+
 import Data.XCB.Types
 import Data.XCB.Python.Parse
 
 import Options.Applicative
 
 import System.Directory
+import System.Environment
 import System.FilePath
 
 data Xcffibgen = Xcffibgen { input :: String
                            , output :: String
+                           , force :: Bool
+                           , tables :: Bool
                            }
 
 options :: Parser Xcffibgen
@@ -22,6 +34,12 @@ options = Xcffibgen
         ( long "output"
        <> metavar "DIR"
        <> help "Output directory for generated python.")
+    <*> switch
+        ( long "force"
+       <> help "Regenerate every module, even ones which haven't changed.")
+    <*> switch
+        ( long "tables"
+       <> help "Emit compact field tables instead of python methods.")
 
 -- Headers we can't emit right now. Obviously we want to get rid of this :-)
 badHeaders :: [String]
@@ -29,18 +47,68 @@ badHeaders = [ "xkb"
              , "xprint"
              ]
 
+-- | The manifest records, for each module in the output directory, a hash of
+-- everything that went into generating it.
+manifestName :: FilePath
+manifestName = ".xcffibgen-manifest"
+
+readManifest :: FilePath -> IO (M.Map String String)
+readManifest out = do
+  let fname = out </> manifestName
+  exists <- doesFileExist fname
+  if exists
+    then do contents <- readFile fname
+            -- force the whole thing, since we overwrite it later
+            length contents `seq` return ()
+            return $ M.fromList [ (n, h) | [n, h] <- map words $ lines contents ]
+    else return M.empty
+
+writeManifest :: FilePath -> M.Map String String -> IO ()
+writeManifest out m =
+  writeFile (out </> manifestName) $
+    unlines [ n ++ " " ++ h | (n, h) <- M.toList m ]
+
+-- | Hash each header's xml together with the xml of everything it
+-- (transitively) imports and the generator itself; if none of those change,
+-- neither does the generated module.
+headerHashes :: FilePath -> BS.ByteString -> [XHeader] -> IO (M.Map String String)
+headerHashes inp self headers = do
+  xmls <- forM headers $ \h -> do
+    let name = xheader_header h
+    contents <- BS.readFile $ inp </> name <.> "xml"
+    return (name, contents)
+  let xmlM = M.fromList xmls
+      importsM = M.fromList [ (xheader_header h, headerImports h) | h <- headers ]
+      closure n = n : concatMap closure (M.findWithDefault [] n importsM)
+      hashOf n = show . md5 . BS.concat $
+        self : [ M.findWithDefault BS.empty d xmlM | d <- nub (closure n) ]
+  return $ M.fromList [ (n, hashOf n) | n <- M.keys xmlM ]
+
 run :: Xcffibgen -> IO ()
-run (Xcffibgen inp out) = do
+run (Xcffibgen inp out forceAll useTables) = do
   headers <- parse inp
   let headers' = filter (flip notElem badHeaders . xheader_header) headers
   createDirectoryIfMissing True out
-  sequence_ $ map processFile $ xform headers'
+
+  self <- getExecutablePath >>= BS.readFile
+  -- The backend affects every module, so it is part of every hash.
+  let backend = if useTables then Tables else Classic
+      self' = BSC.pack $ show (md5 self) ++ show backend
+  hashes <- headerHashes inp self' headers'
+  old <- if forceAll then return M.empty else readManifest out
+  existing <- filterM (\n -> doesFileExist $ out </> n ++ ".py") (M.keys hashes)
+
+  let upToDate n = n `elem` existing && M.lookup n old == M.lookup n hashes
+      todo = filter (not . upToDate . fst) $ xformWith backend headers'
+      -- xform shares the work for common imports between headers, so this
+      -- only parallelises what is left: generating and rendering each module.
+      rendered = parMap rdeepseq (\(n, s) -> (n, renderPy s)) todo
+  mapM_ processFile rendered
+  writeManifest out hashes
   where
-    processFile (fname, suite) = do
+    processFile (fname, contents) = do
       putStrLn fname
-      let fname' = out </> fname ++ ".py"
-          contents = renderPy suite
-      writeFile fname' contents
+      writeFile (out </> fname ++ ".py") contents
 
 main :: IO ()
 main = execParser opts >>= run
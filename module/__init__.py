@@ -1,8 +1,16 @@
 from __future__ import division
 
 import functools
+import select
 import six
 import struct
+import sys
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 from .ffi import ffi, C, bytes_to_cdata, visualtype_to_c_struct
 
@@ -31,11 +39,14 @@ XCB_CONN_CLOSED_PARSE_ERR = C.XCB_CONN_CLOSED_PARSE_ERR
 
 class Unpacker(object):
 
-    def __init__(self, cdata, known_max=None):
+    def __init__(self, cdata, known_max=None, lazy=None):
         self.cdata = cdata
         self.size = 0
         self.offset = 0
         self.known_max = known_max
+        # Composite types whose Lists are decoded lazily, mapped to functions
+        # skipping one of them; see Cookie.reply.
+        self.lazy = lazy
         if self.known_max is not None:
             self._resize(known_max)
 
@@ -100,6 +111,21 @@ class ProtocolException(XcffibException):
     pass
 
 
+class TimeoutException(XcffibException):
+    """ Raised when a wait with a timeout times out. Nothing is lost; the
+    reply, error or event can still be waited for again later. """
+    pass
+
+
+class RequestErrors(XcffibException):
+    """ Raised by Connection.check_all(). `errors` is a list of (cookie,
+    error) pairs, one for each request that failed. """
+
+    def __init__(self, errors):
+        XcffibException.__init__(self, "%d request(s) failed" % len(errors))
+        self.errors = errors
+
+
 core = None
 core_events = None
 core_errors = None
@@ -122,6 +148,7 @@ def _add_core(value, _setup, events, errors):
 
     core = value
     core_events = events
+    _number_events(events)
     core_errors = errors
     setup = _setup
 
@@ -130,6 +157,18 @@ def _add_ext(key, value, events, errors):
     if not issubclass(value, Extension):
         raise XcffibException("Extension type not derived from xcffib.Extension")
     extensions[key] = (value, events, errors)
+    _number_events(events)
+
+
+# The server hands out extension event numbers starting here; everything
+# below belongs to the core protocol.
+_FIRST_EXTENSION_EVENT = 64
+
+
+def _number_events(events):
+    # So that Event.synthetic knows what to put in response_type.
+    for number, event in events.items():
+        event.event_number = number
 
 
 class ExtensionKey(object):
@@ -139,6 +178,15 @@ class ExtensionKey(object):
     def __init__(self, name):
         self.name = name
 
+        # libxcb caches what it knows about an extension (per connection)
+        # under an id it assigns to the xcb_extension_t the first time it
+        # sees it, so we need to use the same one for every request, or each
+        # one costs a QueryExtension round trip.
+        self._c_name = bytes_to_cdata(six.b(name))
+        self.c_ext = ffi.new("xcb_extension_t *")
+        self.c_ext.name = self._c_name
+        self.c_ext.global_id = 0
+
     def __hash__(self):
         return hash(self.name)
 
@@ -170,13 +218,173 @@ class Protobj(object):
         if unpacker.known_max is not None:
             self.bufsize = unpacker.known_max
 
+    @classmethod
+    def synthetic(cls, **fields):
+        """ Make an instance with the attributes `fields`, rather than by
+        decoding one, e.g. to pack it and send it to the server. """
+        obj = cls.__new__(cls)
+        obj.__dict__.update(fields)
+        return obj
+
+
+# Modules generated with the table driven backend (xcffibgen --tables) don't
+# have per class __init__ and pack methods; instead each class has a `_fields`
+# table, which is interpreted by the functions below. A table is a list of:
+#
+# - the struct format string of all the base type fields (plus padding),
+# - the attribute names of those fields, in order,
+# - the remaining fields, each of which is one of:
+#   - [name, type, length]: a List of `type` (a format string or a class);
+#     length is a function of the object decoded so far, or None,
+#   - [name, class]: a Struct or Union,
+#   - [name, format]: a single base type value (only used by unions).
+#
+# pack_union uses the same format for the members of a union.
+
+def _unpack_fields(obj, unpacker, fields, union=False):
+    fmt, names, extras = fields
+    base = unpacker.offset
+    if fmt:
+        values = unpacker.unpack(fmt)
+        for name, value in zip(names, values):
+            setattr(obj, name, value)
+    end = unpacker.offset
+
+    for extra in extras:
+        if union:
+            # Every member of a union starts at the same place.
+            unpacker.offset = base
+        if len(extra) == 3:
+            name, typ, length = extra
+            if length is not None:
+                length = length(obj)
+            value = List(unpacker, typ, length)
+        else:
+            name, typ = extra
+            if isinstance(typ, str):
+                value, = unpacker.unpack(typ)
+            else:
+                value = typ(unpacker)
+        setattr(obj, name, value)
+        end = max(end, unpacker.offset)
+
+    unpacker.offset = end
+    obj.bufsize = end - base
+
+
+def _pack_fields(obj, fields):
+    fmt, names, extras = fields
+    buf = six.BytesIO()
+    if fmt:
+        buf.write(struct.pack("=" + fmt,
+                              *[getattr(obj, name) for name in names]))
+    for extra in extras:
+        buf.write(_pack_member(getattr(obj, extra[0]), extra))
+    return buf.getvalue()
+
+
+def _pack_member(value, member):
+    if len(member) == 3:
+        return pack_list(value, member[1])
+    elif isinstance(member[1], str):
+        return struct.pack("=" + member[1], value)
+    else:
+        return value.pack()
+
+
+def pack_union(obj, members):
+    """ Pack the union `obj`. Its members all overlay each other, so only
+    one of them is packed: the first of `members` which `obj` has, i.e. the
+    first one for a decoded union, or the one it was made with by
+    Union.synthetic(member=value). """
+    for member in members:
+        value = getattr(obj, member[0], None)
+        if value is not None:
+            return _pack_member(value, member)
+    raise XcffibException("None of the members of %s are set" %
+                          type(obj).__name__)
+
+
+class _RequestArgs(dict):
+    """ The arguments of a table driven request; ExprFields look them up as
+    attributes. """
+    __getattr__ = dict.__getitem__
+
+
+def request_method(opcode, args, fmt, names, extras, cookie=None,
+                   is_checked=False):
+    """ Make an Extension method which sends a request described by a table,
+    for modules generated with the table driven backend. `args` are the names
+    of the method's arguments, and `names` the ones packed (in order) with
+    `fmt`. The rest of the request is described by `extras`, each of which is
+    one of:
+
+    - ["list", name, type]: a list argument,
+    - ["struct", name]: a Struct argument,
+    - ["expr", format or None, function]: a value computed from the
+      arguments,
+    - ["valueparam", format, mask name, list name]: a value mask and list.
+    """
+    default_checked = is_checked
+
+    def send(self, *values, **kwargs):
+        is_checked = kwargs.pop("is_checked", default_checked)
+        a = _RequestArgs(zip(args, values))
+        a.update(kwargs)
+
+        buf = six.BytesIO()
+        buf.write(struct.pack("=" + fmt, *[a[name] for name in names]))
+        for extra in extras:
+            kind = extra[0]
+            if kind == "list":
+                buf.write(pack_list(a[extra[1]], extra[2]))
+            elif kind == "struct":
+                buf.write(a[extra[1]].pack())
+            elif kind == "expr":
+                value = extra[2](a)
+                if extra[1] is None:
+                    buf.write(value.pack())
+                else:
+                    buf.write(struct.pack("=" + extra[1], value))
+            elif kind == "valueparam":
+                buf.write(struct.pack("=" + extra[1], a[extra[2]]))
+                buf.write(pack_list(a[extra[3]], "I"))
+
+        if cookie is None:
+            return self.send_request(opcode, buf, is_checked=is_checked)
+        return self.send_request(opcode, buf, cookie, is_checked=is_checked)
+    return send
+
 
 class Struct(Protobj):
-    pass
+
+    # The field table, for table driven modules; see _unpack_fields.
+    _fields = None
+
+    def __init__(self, unpacker):
+        Protobj.__init__(self, unpacker)
+        if self._fields is not None:
+            _unpack_fields(self, unpacker, self._fields)
+
+    def pack(self):
+        if self._fields is None:
+            raise XcffibException("%s can't be packed" % type(self).__name__)
+        return _pack_fields(self, self._fields)
 
 
 class Union(Protobj):
-    pass
+
+    _fields = None
+
+    def __init__(self, unpacker):
+        Protobj.__init__(self, unpacker)
+        if self._fields is not None:
+            _unpack_fields(self, unpacker, self._fields, union=True)
+
+    def pack(self):
+        if self._fields is None:
+            raise XcffibException("%s can't be packed" % type(self).__name__)
+        return pack_union(self, self._fields[2])
 
 
 class Cookie(object):
@@ -186,30 +394,101 @@ class Cookie(object):
         self.sequence = sequence
         self.is_checked = is_checked
 
-    def reply(self):
-        data = self.conn.wait_for_reply(self.sequence)
+        # Whether libxcb is holding on to a reply or error for us which
+        # nobody has asked for yet.
+        self.pending = self.reply_type is not None or is_checked
+        if self.pending:
+            conn.outstanding_replies += 1
+
+    def _claim(self):
+        if self.pending:
+            self.pending = False
+            self.conn.outstanding_replies -= 1
+
+    def raw_reply(self, timeout=None):
+        """ Wait for the reply and return it as an Unpacker, without decoding
+        it. """
+        timed_out = False
+        try:
+            data = self.conn.wait_for_reply(self.sequence, timeout)
+        except TimeoutException:
+            timed_out = True
+            raise
+        finally:
+            if not timed_out:
+                self._claim()
+        if self.conn.recorder is not None:
+            self.conn.recorder.record_reply(self.reply_type, data)
+        return data
+
+    def reply(self, timeout=None, lazy=False):
+        """ Wait for the reply and decode it.
+
+        If `lazy` is set, Lists of variable sized structs in the reply which
+        xcffib knows how to skip over (xproto.STR, FONTPROP, DEPTH and SCREEN)
+        only record where each element is, and decode elements as they are
+        accessed. `lazy` may also be a dict mapping more types to functions
+        which advance an Unpacker past one of them.
+        """
+        data = self.raw_reply(timeout)
+        if lazy:
+            data.lazy = _lazy_skips(lazy)
         return self.reply_type(data)
 
-    def check(self):
+    def check(self, timeout=None):
         # Request is not void and checked.
         assert self.is_checked and self.reply_type is None, (
             "Request is not void and checked")
-        self.conn.request_check(self.sequence)
+        timed_out = False
+        try:
+            self.conn.request_check(self.sequence, timeout)
+        except TimeoutException:
+            timed_out = True
+            raise
+        finally:
+            if not timed_out:
+                self._claim()
+
+    def discard(self):
+        """ Tell libxcb we will never ask for this request's reply (or error),
+        so it can throw it away as soon as it arrives rather than keeping it
+        until the connection is closed. """
+        if self.pending:
+            self._claim()
+            self.conn.discard_reply(self.sequence)
+
+    def __del__(self):
+        if self.pending and self.conn.auto_discard:
+            self.discard()
 
 
 class VoidCookie(Cookie):
-    def reply(self):
+    def reply(self, timeout=None, lazy=False):
         raise XcffibException("No reply for this message type")
 
 
 class Extension(object):
     def __init__(self, conn, key=None):
         self.conn = conn
+        self.key = key
         if key is None:
             self.ext_name = None
         else:
             self.ext_name = key.name
 
+            # This is free if the connection prefetched this extension;
+            # otherwise it is the round trip the first request would have
+            # needed anyway.
+            data = conn.get_extension_data(key)
+            self.present = data.present
+            self.major_opcode = data.major_opcode
+            self.first_event = data.first_event
+            self.first_error = data.first_error
+
+            if self.present:
+                conn._add_extension_events(self.first_event,
+                                           extensions[key][1])
+
     def send_request(self, opcode, data, cookie=VoidCookie, reply=None,
                      is_checked=False):
         data = data.getvalue()
@@ -222,11 +501,11 @@ class Extension(object):
         xcb_req.count = 2
 
         if self.ext_name is not None:
-            key = ffi.new("struct xcb_extension_t *")
-            key.name = bytes_to_cdata(self.ext_name)
-            # xpyb doesn't ever set global_id, which seems wrong, but whatever.
-            key.global_id = 0
-            xcb_req.ext = key
+            # libxcb closes the connection if we try this.
+            if not self.present:
+                raise XcffibException(
+                    "Extension %s is not present" % self.ext_name)
+            xcb_req.ext = self.key.c_ext
         else:
             xcb_req.ext = ffi.NULL
 
@@ -262,46 +541,160 @@ class Extension(object):
         return functools.partial(real, is_checked=is_checked)
 
 
+# Placeholder for elements of a lazy List which haven't been decoded yet.
+_unloaded = object()
+
+
+def skip_str(unpacker):
+    """ Advance `unpacker` past one xproto.STR without decoding it. """
+    name_len, = unpacker.unpack("B")
+    unpacker.offset += name_len
+
+
+def skip_fontprop(unpacker):
+    """ Advance `unpacker` past one xproto.FONTPROP. """
+    unpacker.offset += 8
+
+
+def skip_depth(unpacker):
+    """ Advance `unpacker` past one xproto.DEPTH and its VISUALTYPEs. """
+    visuals_len, = unpacker.unpack("2xH4x")
+    unpacker.offset += 24 * visuals_len
+
+
+def skip_screen(unpacker):
+    """ Advance `unpacker` past one xproto.SCREEN and its DEPTHs. """
+    depths_len, = unpacker.unpack("39xB")
+    for _ in range(depths_len):
+        skip_depth(unpacker)
+
+
+_default_skips = None
+
+
+def _lazy_skips(lazy):
+    global _default_skips
+    if _default_skips is None:
+        # avoid circular imports
+        from . import xproto
+        _default_skips = {
+            xproto.STR: skip_str,
+            xproto.FONTPROP: skip_fontprop,
+            xproto.DEPTH: skip_depth,
+            xproto.SCREEN: skip_screen,
+        }
+    if isinstance(lazy, dict):
+        skips = dict(_default_skips)
+        skips.update(lazy)
+        return skips
+    return _default_skips
+
+
 class List(Protobj):
+
     def __init__(self, unpacker, typ, count=None):
         Protobj.__init__(self, unpacker)
 
-        self.list = []
+        self._items = []
+        self.fmt = None
+        self.raw = None
+        self._offsets = None
         old = unpacker.offset
+        skip = unpacker.lazy.get(typ) if unpacker.lazy else None
 
         if isinstance(typ, str):
-            self.list = list(unpacker.unpack(typ * count))
+            self._items = list(unpacker.unpack(typ * count))
+            # Keep a view of the wire data around so that it can be handed to
+            # numpy (or sent back out via pack_list) without going through
+            # the python objects above.
+            self.fmt = typ
+            self.raw = memoryview(unpacker.buf)[old:unpacker.offset]
+        elif skip is not None:
+            self._scan(unpacker, typ, count, skip)
         elif count is not None:
             for _ in range(count):
                 item = typ(unpacker)
-                self.list.append(item)
+                self._items.append(item)
         else:
             assert unpacker.known_max is not None
             while unpacker.offset < unpacker.known_max:
                 item = typ(unpacker)
-                self.list.append(item)
+                self._items.append(item)
 
         self.bufsize = unpacker.offset - old
 
-        assert count is None or count == len(self.list)
+        assert count is None or count == len(self._items)
+
+    def _scan(self, unpacker, typ, count, skip):
+        """ Record where each element is, without decoding any of them. """
+        self._typ = typ
+        self._cdata = unpacker.cdata
+        self._known_max = unpacker.known_max
+        self._lazy = unpacker.lazy
+        self._offsets = []
+
+        def more():
+            if count is not None:
+                return len(self._offsets) < count
+            return unpacker.offset < unpacker.known_max
+
+        while more():
+            self._offsets.append(unpacker.offset)
+            skip(unpacker)
+        self._items = [_unloaded] * len(self._offsets)
+
+    def _load(self, i):
+        item = self._items[i]
+        if item is _unloaded:
+            unpacker = Unpacker(self._cdata, self._known_max, self._lazy)
+            unpacker.offset = self._offsets[i]
+            item = self._items[i] = self._typ(unpacker)
+        return item
+
+    @property
+    def list(self):
+        """ The elements, as a python list. For a lazy List, this decodes
+        every element. Since the list can be changed by the caller, the List
+        no longer has a view of the wire data afterwards. """
+        if self._offsets is not None:
+            self._items = [self._load(i) for i in range(len(self._items))]
+            self._offsets = None
+        self.raw = None
+        return self._items
+
+    @list.setter
+    def list(self, value):
+        self._items = value
+        self._offsets = None
+        self.raw = None
 
     def __str__(self):
-        return str(self.list)
+        return str(list(self))
 
     def __len__(self):
-        return len(self.list)
+        return len(self._items)
 
     def __iter__(self):
-        return iter(self.list)
+        if self._offsets is None:
+            return iter(self._items)
+        return (self._load(i) for i in range(len(self._items)))
 
     def __getitem__(self, key):
-        return self.list[key]
+        if self._offsets is None:
+            return self._items[key]
+        if isinstance(key, slice):
+            return [self._load(i)
+                    for i in range(*key.indices(len(self._items)))]
+        return self._load(key)
 
     def __setitem__(self, key, value):
         self.list[key] = value
+        self.raw = None
 
     def __delitem__(self, key):
+        # For a lazy List, the offsets would no longer line up; decode it.
         del self.list[key]
+        self.raw = None
 
     def to_string(self):
         """ A helper for converting a List of chars to a native string. Dies if
@@ -313,18 +706,46 @@ class List(Protobj):
             return ''.join([c.decode('latin1') for c in self])
 
     def buf(self):
-        return six.b('').join(self.list)
+        return six.b('').join(list(self))
+
+    def as_array(self):
+        """ Return a numpy array which is a view over the wire data of this
+        list, without copying it. Only lists of base types (i.e. ones that
+        were unpacked with a struct format string) can be viewed this way. """
+        if numpy is None:
+            raise XcffibException("as_array() requires numpy")
+        if self.fmt is None:
+            raise XcffibException("Only lists of base types have an array view")
+        if self.raw is None:
+            raise XcffibException("This list may have been changed since it "
+                                  "was unpacked; use numpy.array(lst.list)")
+        return numpy.frombuffer(self.raw, dtype=numpy.dtype("=" + self.fmt))
+
+    def __array__(self, dtype=None):
+        arr = self.as_array()
+        if dtype is not None:
+            arr = arr.astype(dtype, copy=False)
+        return arr
 
 class Connection(object):
 
-    def __init__(self, display=None, fd=-1, auth=None):
+    def __init__(self, display=None, fd=-1, auth=None, extensions=()):
+        # Where we connected to, so that other connections (e.g. in worker
+        # processes, see xcffib.pool) can connect to the same place.
+        self.display = display
+        self.auth = auth
+
         if auth is not None:
             c_auth = ffi.new("xcb_auth_info_t *")
             if C.xpyb_parse_auth(auth, len(auth), c_auth) < 0:
                 raise XcffibException("invalid xauth")
         else:
             c_auth = ffi.NULL
-        display = display.encode('latin1')
+        if display is None:
+            # i.e. $DISPLAY, or unused if we're given an fd
+            display = ffi.NULL
+        else:
+            display = display.encode('latin1')
 
         i = ffi.new("int *")
 
@@ -336,12 +757,59 @@ class Connection(object):
             self._conn = C.xcb_connect(display, i)
         self.pref_screen = i[0]
 
+        # An optional xcffib.replay.Recorder, which is handed everything we
+        # decode.
+        self.recorder = None
+
+        # Callables which are passed every event we decode; see
+        # add_event_watcher().
+        self.event_watchers = []
+
+        # Event classes of the extensions in use, by response type; filled in
+        # as Extension objects are created. _extension_event_bases has the
+        # first_event of the extension each one came from.
+        self.extension_events = {}
+        self._extension_event_bases = {}
+
+        # The number of cookies whose replies (or errors, for checked
+        # requests) libxcb is keeping for us but nobody has claimed yet.
+        self.outstanding_replies = 0
+
+        # If True, such replies are discarded when their cookie is garbage
+        # collected.
+        self.auto_discard = False
+
         self.core = core(self)
         self.setup = self.get_setup()
 
+        if extensions:
+            self.prefetch_extensions(extensions)
+
     def __call__(self, key):
         return extensions[key][0](self, key)
 
+    def _add_extension_events(self, first_event, events):
+        """ Decode response type `first_event + n` as `events[n]`.
+
+        Extensions without events of their own have a first_event of 0, and
+        GenericEvent numbers (which xcb-types doesn't tell us apart) aren't
+        offsets from first_event at all, so neither is allowed to take over
+        a core event's number. Where two extensions claim the same number,
+        it belongs to the one with the higher first_event: the server never
+        gives out overlapping ranges, so the other one's is a GenericEvent
+        number which ran past the end of its own. """
+        if first_event == 0:
+            return
+        for number, event in events.items():
+            response_type = first_event + number
+            if response_type < _FIRST_EXTENSION_EVENT or response_type > 127:
+                continue
+            base = self._extension_event_bases.get(response_type, 0)
+            if base > first_event:
+                continue
+            self.extension_events[response_type] = event
+            self._extension_event_bases[response_type] = first_event
+
     def invalid(self):
         if self._conn is None:
             raise XcffibException("Invalid connection.")
@@ -375,12 +843,35 @@ class Connection(object):
         return setup(buf)
 
     @ensure_connected
-    def wait_for_event(self):
-        e = C.xcb_wait_for_event(self._conn)
+    def wait_for_event(self, timeout=None):
+        """ Wait for the next event. If `timeout` (in seconds) is not None
+        and no event arrives in that time, raise TimeoutException. """
+        if timeout is None:
+            e = C.xcb_wait_for_event(self._conn)
+        else:
+            deadline = time.time() + timeout
+            C.xcb_flush(self._conn)
+            while True:
+                e = C.xcb_poll_for_event(self._conn)
+                self.invalid()
+                if e != ffi.NULL:
+                    break
+                self._wait_readable(deadline)
         e = ffi.gc(e, C.free)
         self.invalid()
         return self.hoist_event(e)
 
+    def _wait_readable(self, deadline):
+        """ Wait until there is something to read from the server, raising
+        TimeoutException if that doesn't happen before `deadline`. """
+        remaining = deadline - time.time()
+        if remaining > 0:
+            fd = C.xcb_get_file_descriptor(self._conn)
+            readable, _, _ = select.select([fd], [], [], remaining)
+            if readable:
+                return
+        raise TimeoutException("Timed out waiting for the X server")
+
     @ensure_connected
     def poll_for_event(self):
         e = C.xcb_poll_for_event(self._conn)
@@ -406,6 +897,26 @@ class Connection(object):
     def prefetch_maximum_request_length(self):
         return C.xcb_prefetch_maximum_request_length(self._conn)
 
+    @ensure_connected
+    def prefetch_extension_data(self, key):
+        C.xcb_prefetch_extension_data(self._conn, key.c_ext)
+
+    @ensure_connected
+    def get_extension_data(self, key):
+        """ Return the (cached) xcb_query_extension_reply_t for the extension
+        `key`, making a round trip if it hasn't been fetched yet. """
+        data = C.xcb_get_extension_data(self._conn, key.c_ext)
+        self.invalid()
+        return data
+
+    def prefetch_extensions(self, keys):
+        """ Query all the extensions in `keys` with one round trip, rather
+        than one round trip for each the first time it is used. """
+        for key in keys:
+            self.prefetch_extension_data(key)
+        for key in keys:
+            self.get_extension_data(key)
+
     @ensure_connected
     def flush(self):
         return C.xcb_flush(self._conn)
@@ -414,9 +925,29 @@ class Connection(object):
     def generate_id(self):
         return C.xcb_generate_id(self._conn)
 
+    @ensure_connected
+    def generate_ids(self, n):
+        """ Return a list of `n` fresh resource ids. If the id space runs out
+        (i.e. libxcb couldn't get a new range via XC-MISC), the list ends
+        with 0xffffffff. """
+        ids = []
+        for _ in range(n):
+            xid = C.xcb_generate_id(self._conn)
+            ids.append(xid)
+            if xid == 0xffffffff:
+                break
+        return ids
+
     def disconnect(self):
         self.invalid()
-        return C.xcb_disconnect(self._conn)
+        C.xcb_disconnect(self._conn)
+        self._conn = None
+
+    def discard_reply(self, sequence):
+        """ Throw away the reply or error for `sequence` when it arrives. You
+        probably want Cookie.discard() instead. """
+        if self._conn is not None:
+            C.xcb_discard_reply(self._conn, sequence)
 
     def _process_error(self, c_error):
         self.invalid()
@@ -426,11 +957,27 @@ class Connection(object):
             raise error(buf)
 
     @ensure_connected
-    def wait_for_reply(self, sequence):
+    def wait_for_reply(self, sequence, timeout=None):
+        """ Wait for the reply to `sequence`. If `timeout` (in seconds) is not
+        None and the reply doesn't arrive in that time, raise
+        TimeoutException. """
         error_p = ffi.new("xcb_generic_error_t **")
-        data = C.xcb_wait_for_reply(self._conn, sequence, error_p)
+        if timeout is None:
+            data = C.xcb_wait_for_reply(self._conn, sequence, error_p)
+        else:
+            deadline = time.time() + timeout
+            reply_p = ffi.new("void **")
+            C.xcb_flush(self._conn)
+            while not C.xcb_poll_for_reply(self._conn, sequence, reply_p,
+                                           error_p):
+                self.invalid()
+                self._wait_readable(deadline)
+            data = reply_p[0]
         data = ffi.gc(data, C.free)
 
+        if self.recorder is not None and error_p[0] != ffi.NULL:
+            self.recorder.record_error(error_p[0])
+
         try:
             self._process_error(error_p[0])
         finally:
@@ -446,29 +993,88 @@ class Connection(object):
         # why is this 32 and not sizeof(xcb_generic_reply_t) == 8?
         return Unpacker(data, known_max=32 + reply.length * 4)
 
+    def check_all(self, cookies, raise_errors=True):
+        """ Check many checked void requests with a single round trip.
+
+        Returns a list of (cookie, error) pairs for the requests that
+        failed, or if `raise_errors` is true and any did, raises a
+        RequestErrors containing that list.
+        """
+        cookies = list(cookies)
+        if cookies:
+            # Once the reply to this arrives, every error for an earlier
+            # request has too, so libxcb doesn't need to sync again for each
+            # of the checks below.
+            self.core.GetInputFocus().reply()
+
+        failures = []
+        for cookie in cookies:
+            try:
+                cookie.check()
+            except Error as e:
+                failures.append((cookie, e))
+
+        if failures and raise_errors:
+            raise RequestErrors(failures)
+        return failures
+
     @ensure_connected
-    def request_check(self, sequence):
+    def request_check(self, sequence, timeout=None):
+        if timeout is not None:
+            # xcb_request_check blocks on a sync of its own unless it already
+            # knows the request is done; make sure it does, without blocking.
+            sync = self.core.GetInputFocus()
+            try:
+                sync.reply(timeout)
+            except TimeoutException:
+                sync.discard()
+                raise
+
         cookie = ffi.new("xcb_void_cookie_t [1]")
         cookie[0].sequence = sequence
 
         err = C.xcb_request_check(self._conn, cookie[0])
+        if self.recorder is not None and err != ffi.NULL:
+            self.recorder.record_error(err)
         self._process_error(err)
 
     def hoist_event(self, e):
         """ Hoist an xcb_generic_event_t to the right xcffib structure. """
         if e.response_type == 0:
+            if self.recorder is not None:
+                self.recorder.record_error(e)
             return self._process_error(ffi.cast("xcb_generic_error_t *", e))
 
-        if e.response_type > 128:
-            # avoid circular imports
-            from .xproto import ClientMessageEvent
-            event = ClientMessageEvent
-        else:
-            assert core_events, "You probably need to import xcffib.xproto"
-            event = core_events[e.response_type & 0x7f]
-
         buf = Unpacker(e)
-        return event(buf)
+        event = self.extension_events.get(e.response_type & 0x7f)
+        if event is None:
+            event = _event_type(e.response_type)
+        if self.recorder is not None:
+            self.recorder.record_event(e, event)
+        event = event(buf)
+        for watcher in self.event_watchers:
+            watcher(event)
+        return event
+
+    def add_event_watcher(self, watcher):
+        """ Call `watcher(event)` for every event decoded on this connection,
+        before it is returned to the caller. This is for things like caches
+        which need to see events, but shouldn't have to own the event loop. """
+        self.event_watchers.append(watcher)
+
+    def remove_event_watcher(self, watcher):
+        self.event_watchers.remove(watcher)
+
+
+def _event_type(response_type):
+    """ Return the xcffib.Event subclass for a (non-zero) response type. """
+    if response_type > 128:
+        # avoid circular imports
+        from .xproto import ClientMessageEvent
+        return ClientMessageEvent
+    else:
+        assert core_events, "You probably need to import xcffib.xproto"
+        return core_events[response_type & 0x7f]
 
 
 # More backwards compatibility
@@ -476,6 +1082,9 @@ connect = Connection
 
 
 class Response(Protobj):
+
+    _fields = None
+
     def __init__(self, unpacker):
         Protobj.__init__(self, unpacker)
 
@@ -494,10 +1103,64 @@ class Reply(Response):
         # also for compat
         resp = unpacker.cast("xcb_generic_reply_t *")
         self.length = resp.length
+        if self._fields is not None:
+            _unpack_fields(self, unpacker, self._fields)
 
 
 class Event(Response):
-    pass
+
+    # The event's number, set when its module is loaded; extension events
+    # are numbered from zero, not from the extension's first_event.
+    event_number = None
+
+    def __init__(self, unpacker):
+        Response.__init__(self, unpacker)
+        if self._fields is not None:
+            _unpack_fields(self, unpacker, self._fields)
+
+    @classmethod
+    def synthetic(cls, response_type=None, **fields):
+        """ Make an event to send with SendEvent, e.g.:
+
+            ev = xproto.ClientMessageEvent.synthetic(
+                format=32, window=w, type=atom,
+                data=xproto.ClientMessageData.synthetic(data32=[1, 2, 3, 4, 5]))
+            conn.core.SendEvent(False, w, xproto.EventMask.NoEvent, ev.pack())
+
+        `response_type` defaults to the event's number, which is right for
+        core events; an extension's events need the extension's first_event
+        added to it. The sequence number is filled in by the server.
+        """
+        if response_type is None:
+            response_type = cls.event_number
+        return super(Event, cls).synthetic(response_type=response_type,
+                                           sequence=0, **fields)
+
+    def pack(self):
+        """ Pack the event into the 32 bytes SendEvent wants. """
+        if self._fields is None:
+            raise XcffibException("%s can't be packed" % type(self).__name__)
+        fmt, names, extras = self._fields
+        # The format starts with a pad byte for the response type.
+        packer = _event_structs.get(fmt)
+        if packer is None:
+            packer = _event_structs[fmt] = struct.Struct("=B" + fmt[1:])
+        data = packer.pack(self.response_type,
+                           *[getattr(self, name) for name in names])
+        for extra in extras:
+            data += _pack_member(getattr(self, extra[0]), extra)
+        return pad_event(data)
+
+
+# Precompiled Structs for table driven events, by format.
+_event_structs = {}
+
+
+def pad_event(data):
+    """ Pad a packed event to the 32 bytes every (non generic) event is. """
+    if len(data) < 32:
+        data += six.b("\0") * (32 - len(data))
+    return data
 
 
 class Error(Response, XcffibException):
@@ -505,15 +1168,62 @@ class Error(Response, XcffibException):
         Response.__init__(self, unpacker)
         XcffibException.__init__(self)
         self.code = unpacker.unpack('B', increment=False)
+        if self._fields is not None:
+            _unpack_fields(self, unpacker, self._fields)
+
+
+_INTEGER_CODES = "bBhHiIlLqQ"
+_NATIVE_ORDER = "<" if sys.byteorder == "little" else ">"
+
+
+def _same_kind(code, fmt):
+    """ Whether items with the struct code `code` are packed like `fmt`
+    (given that they are the same size): integers are integers whatever
+    their signedness, and chars are bytes. """
+    if code == fmt:
+        return True
+    if code in _INTEGER_CODES:
+        return fmt in _INTEGER_CODES or fmt == "c"
+    return code == "c" and fmt in "bB"
+
+
+def _buffer_bytes(from_, fmt):
+    """ Return the contents of `from_` as bytes if it supports the buffer
+    protocol with native order items of the same kind and size as `fmt`,
+    otherwise None. """
+    size = struct.calcsize("=" + fmt)
+    if isinstance(from_, List):
+        if from_.raw is None or not _same_kind(from_.fmt, fmt) or \
+                struct.calcsize("=" + from_.fmt) != size:
+            return None
+        return from_.raw.tobytes()
+    try:
+        view = memoryview(from_)
+    except TypeError:
+        return None
+    code = view.format
+    if code[:1] in ("@", "=", _NATIVE_ORDER):
+        code = code[1:]
+    if view.itemsize != size or not _same_kind(code, fmt):
+        return None
+    return view.tobytes()
 
 
 def pack_list(from_, pack_type):
     """ Return the wire packed version of `from_`. `pack_type` should be some
     subclass of `xcffib.Struct`, or a string that can be passed to
     `struct.pack`. You must pass `size` if `pack_type` is a struct.pack string.
+
+    If `pack_type` is a struct.pack string and `from_` supports the buffer
+    protocol (bytes, bytearray, array.array, numpy arrays, ...) with native
+    order items of the same kind and size, its memory is used directly
+    instead of packing each item individually.
     """
 
     if isinstance(pack_type, six.string_types):
+        packed = _buffer_bytes(from_, pack_type)
+        if packed is not None:
+            return packed
         return struct.pack("=" + pack_type * len(from_), *tuple(from_))
     else:
         buf = six.BytesIO()
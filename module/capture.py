@@ -0,0 +1,140 @@
+# Incremental screen capture driven by the DAMAGE extension.
+
+from . import XcffibException
+from . import xproto
+from . import xfixes
+from . import damage
+from .image import SharedImage, image_stride, pixmap_format
+
+
+class DamageCapture(object):
+    """ Keeps a copy of a drawable's contents up to date by fetching only the
+    parts of it which have changed.
+
+    The whole drawable is read once up front. After that, DAMAGE tells us
+    (via a damage.NotifyEvent, which the capture sees as your event loop
+    decodes it) when something has been drawn, and `update()` fetches just
+    the damaged rectangles, through MIT-SHM when possible, and patches them
+    into `frame`, a SharedImage of the whole drawable.
+    """
+
+    def __init__(self, conn, drawable, use_shm=True):
+        self.conn = conn
+        self.drawable = drawable
+
+        self.xfixes = conn(xfixes.key)
+        self.damage = conn(damage.key)
+        if not (self.xfixes.present and self.damage.present):
+            raise XcffibException("DamageCapture needs XFIXES and DAMAGE")
+        # Both extensions require the version to be negotiated before use.
+        xf = self.xfixes.QueryVersion(5, 0)
+        dm = self.damage.QueryVersion(1, 1)
+        xf.reply()
+        dm.reply()
+
+        geom = conn.core.GetGeometry(drawable).reply()
+        self.width = geom.width
+        self.height = geom.height
+        self.depth = geom.depth
+        self.frame = SharedImage(conn, geom.width, geom.height, geom.depth,
+                                 use_shm)
+        # Rectangles are read into this one before being copied into place.
+        self._scratch = SharedImage(conn, geom.width, geom.height, geom.depth,
+                                    use_shm) if self.frame.shm else None
+        self._bytes_per_pixel = pixmap_format(conn.setup,
+                                              self.depth).bits_per_pixel // 8
+        if self._bytes_per_pixel == 0:
+            raise XcffibException("DamageCapture needs >= 8 bits per pixel")
+
+        self.damage_id = conn.generate_id()
+        self.damage.Create(self.damage_id, drawable,
+                           damage.ReportLevel.NonEmpty)
+        self.region = conn.generate_id()
+        self.xfixes.CreateRegion(self.region, [])
+
+        self.dirty = False
+        conn.add_event_watcher(self._event)
+        self.frame.get_image_shm(drawable)
+
+    def _event(self, event):
+        if isinstance(event, damage.NotifyEvent) and \
+                event.damage == self.damage_id:
+            self.dirty = True
+
+    def update(self, force=False):
+        """ If anything has been damaged since the last update (or if
+        `force`), fetch the damaged rectangles into `frame`. Returns the
+        list of (x, y, width, height) rectangles that were updated. """
+        if not (self.dirty or force):
+            return []
+        self.dirty = False
+
+        # Move the accumulated damage into our region, and clear it.
+        self.damage.Subtract(self.damage_id, xfixes.Region._None, self.region)
+        reply = self.xfixes.FetchRegion(self.region).reply()
+        rects = [(r.x, r.y, r.width, r.height) for r in reply.rectangles]
+
+        if self.frame.shm:
+            self._fetch_shm(rects)
+        else:
+            fmt = xproto.ImageFormat.ZPixmap
+            cookies = [self.conn.core.GetImage(fmt, self.drawable, x, y, w, h,
+                                               0xffffffff)
+                       for x, y, w, h in rects]
+            for rect, cookie in zip(rects, cookies):
+                self._patch(rect, cookie.reply().data.raw)
+        return rects
+
+    def _fetch_shm(self, rects):
+        # Each rectangle gets its own part of the scratch segment, so all of
+        # their GetImages can be sent before waiting for any of them. The
+        # damaged rectangles don't overlap, so they nearly always fit; if the
+        # row padding makes them not, the ones so far are patched first.
+        scratch = self._scratch
+        pending = []
+        offset = 0
+        for rect in rects:
+            x, y, w, h = rect
+            size = image_stride(self.conn.setup, self.depth, w) * h
+            if offset + size > scratch.size and pending:
+                self._patch_shm(pending)
+                pending = []
+                offset = 0
+            cookie = scratch.ext.GetImage(self.drawable, x, y, w, h,
+                                          0xffffffff,
+                                          xproto.ImageFormat.ZPixmap,
+                                          scratch.shmseg, offset)
+            pending.append((rect, offset, size, cookie))
+            offset += (size + 3) & ~3
+        self._patch_shm(pending)
+
+    def _patch_shm(self, pending):
+        for _, _, _, cookie in pending:
+            cookie.reply()
+        buf = self._scratch.buf
+        for rect, offset, size, _ in pending:
+            self._patch(rect, buf[offset:offset + size])
+
+    def _patch(self, rect, data):
+        """ Copy the ZPixmap image `data` of `rect` into the frame. """
+        x, y, w, h = rect
+        src_stride = image_stride(self.conn.setup, self.depth, w)
+        row_bytes = w * self._bytes_per_pixel
+        dst = self.frame.buf
+        dst_stride = self.frame.stride
+        for row in range(h):
+            src = row * src_stride
+            start = (y + row) * dst_stride + x * self._bytes_per_pixel
+            dst[start:start + row_bytes] = data[src:src + row_bytes]
+
+    def array(self):
+        """ Return a numpy view of the frame; see SharedImage.array. """
+        return self.frame.array()
+
+    def close(self):
+        self.conn.remove_event_watcher(self._event)
+        self.damage.Destroy(self.damage_id)
+        self.xfixes.DestroyRegion(self.region)
+        if self._scratch is not None:
+            self._scratch.close()
+        self.frame.close()
@@ -0,0 +1,118 @@
+# Opt-in event coalescing: collapse bursts of events where only the latest
+# state matters before they are decoded.
+
+import collections
+import struct
+
+from .ffi import ffi, C
+
+# Core event numbers and the offset of the window each event is about in the
+# raw 32 byte event.
+MOTION_NOTIFY = 6
+EXPOSE = 12
+CONFIGURE_NOTIFY = 22
+
+DEFAULT_TYPES = {
+    MOTION_NOTIFY: 12,     # event
+    CONFIGURE_NOTIFY: 8,   # window
+}
+
+
+class EventCoalescer(object):
+    """ A wrapper around a connection's event queue which coalesces events.
+
+    For event types in `types` (a dict mapping an event number to the offset
+    of a window field in the raw event), only the newest event for each
+    (type, window) in the currently queued batch is delivered, at the position
+    of that newest event. If `merge_expose` is true, the Expose events for a
+    window are merged until one with count == 0 arrives; a single Expose with
+    the bounding box of all of them is delivered, with the individual
+    rectangles available as its `rects` attribute.
+
+    Coalescing happens on the raw events, so dropped events are never
+    decoded. Use `poll_for_event` and `wait_for_event` on this object instead
+    of the connection's.
+    """
+
+    def __init__(self, conn, types=None, merge_expose=True):
+        self.conn = conn
+        self.types = dict(DEFAULT_TYPES if types is None else types)
+        self.merge_expose = merge_expose
+        self._ready = collections.deque()
+        self._exposes = {}
+
+    def _fill(self, first=None):
+        batch = []
+        latest = {}
+        e = first
+        while True:
+            if e is None:
+                e = C.xcb_poll_for_event(self.conn._conn)
+                if e == ffi.NULL:
+                    break
+                e = ffi.gc(e, C.free)
+            self._add(batch, latest, e)
+            e = None
+        self.conn.invalid()
+        self._ready.extend(item for item in batch if item is not None)
+
+    def _add(self, batch, latest, e):
+        rtype = e.response_type & 0x7f
+        offset = self.types.get(rtype)
+        if offset is not None:
+            window, = struct.unpack_from("=I", ffi.buffer(e), offset)
+            key = (rtype, window)
+            idx = latest.get(key)
+            if idx is not None:
+                batch[idx] = None
+            latest[key] = len(batch)
+            batch.append((e, None))
+        elif rtype == EXPOSE and self.merge_expose:
+            buf = ffi.buffer(e)
+            window, = struct.unpack_from("=I", buf, 4)
+            x, y, w, h, count = struct.unpack_from("=HHHHH", buf, 8)
+            rects = self._exposes.setdefault(window, [])
+            rects.append((x, y, w, h))
+            if count == 0:
+                del self._exposes[window]
+                batch.append((self._merge_expose(e, rects), rects))
+        else:
+            batch.append((e, None))
+
+    def _merge_expose(self, e, rects):
+        x0 = min(r[0] for r in rects)
+        y0 = min(r[1] for r in rects)
+        x1 = max(r[0] + r[2] for r in rects)
+        y1 = max(r[1] + r[3] for r in rects)
+
+        merged = ffi.new("xcb_generic_event_t *")
+        buf = ffi.buffer(merged)
+        buf[:] = ffi.buffer(e)[:]
+        struct.pack_into("=HHHHH", buf, 8, x0, y0, x1 - x0, y1 - y0, 0)
+        return merged
+
+    def _hoist(self):
+        e, rects = self._ready.popleft()
+        event = self.conn.hoist_event(e)
+        if rects is not None:
+            event.rects = rects
+        return event
+
+    def poll_for_event(self):
+        """ Return the next (coalesced) event, or None if there isn't one. """
+        if not self._ready:
+            self.conn.invalid()
+            self._fill()
+        if self._ready:
+            return self._hoist()
+        return None
+
+    def wait_for_event(self):
+        """ Block until there is an event, then return the next (coalesced)
+        event. """
+        while not self._ready:
+            self.conn.invalid()
+            e = C.xcb_wait_for_event(self.conn._conn)
+            self.conn.invalid()
+            self._fill(ffi.gc(e, C.free))
+        return self._hoist()
@@ -154,6 +154,7 @@ ffi.cdef("""
     xcb_generic_event_t *xcb_wait_for_event(xcb_connection_t *c);
     xcb_generic_event_t *xcb_poll_for_event(xcb_connection_t *c);
     const xcb_query_extension_reply_t *xcb_get_extension_data(xcb_connection_t *c, xcb_extension_t *ext);
+    void xcb_prefetch_extension_data(xcb_connection_t *c, xcb_extension_t *ext);
     const xcb_setup_t *xcb_get_setup(xcb_connection_t *c);
     int xcb_get_file_descriptor(xcb_connection_t *c);
     int xcb_connection_has_error(xcb_connection_t *c);
@@ -170,9 +171,27 @@ ffi.cdef("""
     unsigned int xcb_send_request(xcb_connection_t *c, int flags, struct iovec *vector, const xcb_protocol_request_t *request);
     void *xcb_wait_for_reply(xcb_connection_t *c, unsigned int request, xcb_generic_error_t **e);
     int xcb_poll_for_reply(xcb_connection_t *c, unsigned int request, void **reply, xcb_generic_error_t **error);
+    void xcb_discard_reply(xcb_connection_t *c, unsigned int sequence);
+""")
+
+# SysV shared memory, for use with MIT-SHM
+ffi.cdef("""
+    #define IPC_PRIVATE ...
+    #define IPC_CREAT ...
+    #define IPC_RMID ...
+
+    typedef int key_t;
+    struct shmid_ds { ...; };
+
+    int shmget(key_t key, size_t size, int shmflg);
+    void *shmat(int shmid, const void *shmaddr, int shmflg);
+    int shmdt(const void *shmaddr);
+    int shmctl(int shmid, int cmd, struct shmid_ds *buf);
 """)
 
 C = ffi.verify("""
+    #include <sys/ipc.h>
+    #include <sys/shm.h>
     #include <xcb/xcb.h>
     #include <xcb/xcbext.h>
 """, libraries=['xcb'])
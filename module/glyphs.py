@@ -0,0 +1,293 @@
+# Client side caching of RENDER glyphs and pictures, for drawing the same
+# text over and over without uploading it over and over.
+
+import array
+import collections
+import six
+import struct
+
+from . import XcffibException
+from . import render
+
+# An array typecode for 32 bit glyph ids.
+_CARD32 = 'I' if array.array('I').itemsize == 4 else 'L'
+
+_GLYPHINFO = struct.Struct("=HHhhhh")
+# A GLYPHELT header: the number of glyphs, and the offset of the first one.
+_ELT = struct.Struct("=B3xhh")
+# A glyph element with a count of 255 switches to another glyphset.
+_SWITCH = struct.Struct("=B3xhhI")
+_MAX_ELT = 254
+
+
+def _tobytes(a):
+    # array.tobytes() is new in python 3
+    return a.tobytes() if hasattr(a, "tobytes") else a.tostring()
+
+
+def pack_glyph_elts(runs, width):
+    """ Pack the element list ("glyphcmds") of a CompositeGlyphs8, 16 or 32
+    request, for `width` 1, 2 or 4 respectively.
+
+    `runs` is a sequence of (glyphset, dx, dy, ids): the glyph ids `ids` (a
+    sequence of ints, e.g. an array) are drawn starting `dx`, `dy` from where
+    the previous run finished (or from the origin, for the first run). If
+    `glyphset` is not None, the run is drawn from that glyphset, otherwise
+    from the one in use.
+    """
+    typecode = {1: 'B', 2: 'H', 4: _CARD32}[width]
+    parts = []
+    for glyphset, dx, dy, ids in runs:
+        if glyphset is not None:
+            parts.append(_SWITCH.pack(255, 0, 0, glyphset))
+        packed = _tobytes(array.array(typecode, ids))
+        for start in range(0, max(len(ids), 1), _MAX_ELT):
+            chunk = packed[start * width:(start + _MAX_ELT) * width]
+            parts.append(_ELT.pack(len(chunk) // width, dx, dy))
+            parts.append(chunk)
+            parts.append(six.b("\0") * (-len(chunk) & 3))
+            dx = dy = 0
+    return six.b("").join(parts)
+
+
+def find_a8_format(conn):
+    """ Return the id of the RENDER picture format with only an 8 bit alpha
+    channel, which is what anti-aliased glyphs use. """
+    reply = conn(render.key).QueryPictFormats().reply()
+    for fmt in reply.formats:
+        d = fmt.direct
+        if (fmt.type == render.PictType.Direct and fmt.depth == 8 and
+                d.alpha_mask == 0xff and d.alpha_shift == 0 and
+                d.red_mask == d.green_mask == d.blue_mask == 0):
+            return fmt.id
+    raise XcffibException("No A8 picture format")
+
+
+class FontGlyphs(object):
+    """ The glyphs of one font (at one size) which are in the server, in a
+    GlyphSet of their own; see GlyphCache.font. """
+
+    def __init__(self, cache, key, loader):
+        self.cache = cache
+        self.key = key
+        self.loader = loader
+        self.glyphset = cache.conn.generate_id()
+        cache.render.CreateGlyphSet(self.glyphset, cache.format)
+
+        # glyph key -> (glyph id, x advance, y advance), least recently used
+        # first.
+        self.glyphs = collections.OrderedDict()
+        self._free_ids = []
+        self._next_id = 1
+        # Recently drawn strings -> (glyph ids, x advance, y advance), so
+        # that redrawing them is a single lookup. Emptied whenever a glyph
+        # is evicted.
+        self._runs = collections.OrderedDict()
+
+    def lookup(self, text, keep=None):
+        """ Return (ids, x advance, y advance) for the glyphs of `text` (a
+        string, or a tuple of glyph keys), uploading any that aren't in the
+        server yet.
+
+        Making room for them won't evict any of the glyphs in `keep`, a set
+        of glyph keys, to which the keys of `text` are added; pass the same
+        set to each lookup whose ids will be drawn by one request. """
+        if keep is None:
+            keep = set()
+        run = self._runs.pop(text, None)
+        if run is None:
+            run = self._lookup(text, keep)
+            while len(self._runs) >= self.cache.max_runs:
+                self._runs.popitem(last=False)
+        else:
+            # The glyphs are in use even though they weren't looked up, so
+            # that strings drawn every frame aren't the first to go.
+            glyphs = self.glyphs
+            for key in text:
+                glyphs[key] = glyphs.pop(key)
+            keep.update(text)
+        self._runs[text] = run
+        return run
+
+    def _lookup(self, text, keep):
+        glyphs = self.glyphs
+        missing = []
+        for key in text:
+            entry = glyphs.pop(key, None)
+            if entry is None:
+                if key not in missing:
+                    missing.append(key)
+            else:
+                glyphs[key] = entry
+                keep.add(key)
+        if missing:
+            self._upload(missing, keep)
+            keep.update(missing)
+
+        ids = array.array(_CARD32)
+        x = y = 0
+        for key in text:
+            glyph, x_off, y_off = glyphs[key]
+            ids.append(glyph)
+            x += x_off
+            y += y_off
+        return ids, x, y
+
+    def _upload(self, keys, keep):
+        glyphs = self.glyphs
+        # Make room by evicting the least recently used glyphs, but not any
+        # of the ones we're about to draw (`keep`, which were all moved to
+        # the end when they were looked up). If the text needs more than
+        # max_glyphs glyphs, so be it.
+        evicted = array.array(_CARD32)
+        excess = len(glyphs) + len(keys) - self.cache.max_glyphs
+        while excess > 0 and glyphs:
+            key = next(iter(glyphs))
+            if key in keep:
+                break
+            evicted.append(glyphs.pop(key)[0])
+            excess -= 1
+        if evicted:
+            self.cache.render.FreeGlyphs(self.glyphset, evicted)
+            self._free_ids.extend(evicted)
+            self._runs.clear()
+
+        ids = array.array(_CARD32)
+        infos = []
+        data = []
+        for key in keys:
+            width, height, x, y, x_off, y_off, image = self.loader(key)
+            glyph = self._free_ids.pop() if self._free_ids else self._new_id()
+            ids.append(glyph)
+            infos.append(_GLYPHINFO.pack(width, height, x, y, x_off, y_off))
+            data.append(image)
+            glyphs[key] = (glyph, x_off, y_off)
+
+        self.cache.render.AddGlyphs(self.glyphset, len(ids), ids,
+                                    [six.b("").join(infos)],
+                                    six.b("").join(data))
+
+    def _new_id(self):
+        glyph = self._next_id
+        self._next_id += 1
+        return glyph
+
+    def close(self):
+        self.cache.render.FreeGlyphSet(self.glyphset)
+        self.glyphs.clear()
+        self._runs.clear()
+
+
+class GlyphCache(object):
+    """ Uploads glyphs to the server once, and draws runs of them with
+    CompositeGlyphs requests whose element lists are packed directly from
+    arrays of glyph ids.
+
+    Each font (see `font`) gets its own GlyphSet, and keeps at most
+    `max_glyphs` glyphs in it, evicting the least recently used ones first.
+    Glyphs are loaded by a function supplied with the font; the cache only
+    knows about glyph keys (e.g. characters), never about rasterizing them.
+
+    Solid fill pictures, e.g. for the colour of text, are cached too, at
+    most `max_pictures` of them.
+    """
+
+    def __init__(self, conn, max_glyphs=1024, max_pictures=64, max_runs=256,
+                 format=None):
+        self.conn = conn
+        self.render = conn(render.key)
+        if not self.render.present:
+            raise XcffibException("GlyphCache needs RENDER")
+        self.render.QueryVersion(0, 11).reply()
+
+        self.format = format if format is not None else find_a8_format(conn)
+        self.max_glyphs = max_glyphs
+        self.max_pictures = max_pictures
+        self.max_runs = max_runs
+        self.fonts = {}
+        self._pictures = collections.OrderedDict()
+
+    def font(self, key, loader):
+        """ Return the FontGlyphs for the font `key` (anything hashable, e.g.
+        a (family, size) tuple), creating it if necessary.
+
+        `loader(glyph_key)` is called for each glyph the first time it is
+        drawn (and again if it has been evicted since), and should return
+        (width, height, x, y, x_off, y_off, image): the xRender GLYPHINFO of
+        the glyph, and its 8 bit alpha image, with each row padded to a
+        multiple of 4 bytes.
+        """
+        font = self.fonts.get(key)
+        if font is None:
+            font = self.fonts[key] = FontGlyphs(self, key, loader)
+        return font
+
+    def solid(self, color):
+        """ Return a solid fill picture of `color`, a 16 bit per channel
+        (red, green, blue, alpha) tuple. """
+        color = tuple(color)
+        picture = self._pictures.pop(color, None)
+        if picture is None:
+            picture = self.conn.generate_id()
+            red, green, blue, alpha = color
+            self.render.CreateSolidFill(picture, render.COLOR.synthetic(
+                red=red, green=green, blue=blue, alpha=alpha))
+            while len(self._pictures) >= self.max_pictures:
+                _, old = self._pictures.popitem(last=False)
+                self.render.FreePicture(old)
+        self._pictures[color] = picture
+        return picture
+
+    def composite(self, op, src, dst, runs, src_x=0, src_y=0):
+        """ Draw `runs`, a sequence of (font, text, x, y), onto the picture
+        `dst` with one CompositeGlyphs request. Each run starts at (x, y) in
+        `dst`; `src` is positioned so that (src_x, src_y) lines up with the
+        start of the first run. """
+        elts = []
+        first = glyphset = None
+        pen_x = pen_y = 0
+        largest = 0
+        # The glyphs of every run, by font, so that looking up a later run
+        # doesn't evict (and reuse the ids of) those of an earlier one.
+        keep = {}
+        for font, text, x, y in runs:
+            ids, advance_x, advance_y = font.lookup(
+                text, keep.setdefault(font, set()))
+            switch = None
+            if first is None:
+                # the first glyphset is given in the request itself
+                first = glyphset = font.glyphset
+            elif font.glyphset != glyphset:
+                switch = glyphset = font.glyphset
+            elts.append((switch, x - pen_x, y - pen_y, ids))
+            pen_x = x + advance_x
+            pen_y = y + advance_y
+            if ids:
+                largest = max(largest, max(ids))
+        if not elts:
+            return None
+
+        if largest < 1 << 8:
+            request, width = self.render.CompositeGlyphs8, 1
+        elif largest < 1 << 16:
+            request, width = self.render.CompositeGlyphs16, 2
+        else:
+            request, width = self.render.CompositeGlyphs32, 4
+        return request(op, src, dst, self.format, first, src_x, src_y,
+                       pack_glyph_elts(elts, width))
+
+    def draw_text(self, dst, font, text, x, y, color=(0, 0, 0, 0xffff),
+                  op=render.PictOp.Over):
+        """ Draw `text` in `font` at (x, y) on the picture `dst`, in a solid
+        `color`. """
+        return self.composite(op, self.solid(color), dst,
+                              [(font, text, x, y)])
+
+    def close(self):
+        """ Free all the glyphsets and pictures. """
+        for font in self.fonts.values():
+            font.close()
+        self.fonts.clear()
+        for picture in self._pictures.values():
+            self.render.FreePicture(picture)
+        self._pictures.clear()
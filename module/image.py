@@ -0,0 +1,240 @@
+# Helpers for moving image data between the X server and numpy without
+# converting every pixel to a python object along the way.
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from . import XcffibException, Error
+from .ffi import ffi, C
+from . import xproto
+from . import shm
+
+
+def pixmap_format(setup, depth):
+    """ Return the xproto.FORMAT from `setup` describing how images of
+    `depth` are laid out in ZPixmap format. """
+    for fmt in setup.pixmap_formats:
+        if fmt.depth == depth:
+            return fmt
+    raise XcffibException("No pixmap format for depth %d" % depth)
+
+
+def image_stride(setup, depth, width):
+    """ Return the number of bytes in one scanline of a ZPixmap image of
+    `depth` and `width`. """
+    fmt = pixmap_format(setup, depth)
+    bits = width * fmt.bits_per_pixel
+    pad = fmt.scanline_pad
+    return ((bits + pad - 1) // pad) * pad // 8
+
+
+def image_array(setup, depth, data, width, height):
+    """ Return a numpy view of the ZPixmap image `data` (anything supporting
+    the buffer protocol, e.g. `GetImageReply.data`), without copying it.
+
+    8, 16 and 32 bits per pixel images come back with shape (height, width)
+    and an unsigned dtype of that size in the server's byte order. 24 bits per
+    pixel images come back with shape (height, width, 3). Anything else comes
+    back as the raw (height, stride) bytes.
+    """
+    if numpy is None:
+        raise XcffibException("image_array() requires numpy")
+
+    if hasattr(data, "raw"):
+        data = data.raw
+    if data is None:
+        raise XcffibException("Image data has no buffer")
+
+    bpp = pixmap_format(setup, depth).bits_per_pixel
+    stride = image_stride(setup, depth, width)
+    order = '<' if setup.image_byte_order == xproto.ImageOrder.LSBFirst else '>'
+
+    if bpp in (8, 16, 32):
+        dtype = numpy.dtype(order + 'u%d' % (bpp // 8))
+        shape = (height, width)
+        strides = (stride, dtype.itemsize)
+    elif bpp == 24:
+        dtype = numpy.dtype('u1')
+        shape = (height, width, 3)
+        strides = (stride, 3, 1)
+    else:
+        dtype = numpy.dtype('u1')
+        shape = (height, stride)
+        strides = (stride, 1)
+
+    return numpy.ndarray(shape=shape, dtype=dtype, buffer=data,
+                         strides=strides)
+
+
+def get_image_array(conn, drawable, x, y, width, height,
+                    plane_mask=0xffffffff):
+    """ Fetch a ZPixmap image of the given area of `drawable` and return it
+    as a numpy view (see `image_array`) over the reply data. """
+    reply = conn.core.GetImage(xproto.ImageFormat.ZPixmap, drawable, x, y,
+                               width, height, plane_mask).reply()
+    return image_array(conn.setup, reply.depth, reply.data, width, height)
+
+
+def create_segment(size):
+    """ Create a SysV shared memory segment of `size` bytes and attach it to
+    this process. Returns (shmid, address), or None if that fails. The
+    segment isn't marked for removal. """
+    shmid = C.shmget(C.IPC_PRIVATE, size, C.IPC_CREAT | 0o600)
+    if shmid < 0:
+        return None
+    addr = C.shmat(shmid, ffi.NULL, 0)
+    if addr == ffi.cast("void *", -1):
+        C.shmctl(shmid, C.IPC_RMID, ffi.NULL)
+        return None
+    return shmid, addr
+
+
+def attach_segment(conn, ext, size, remove=True):
+    """ Create a segment (see `create_segment`) and attach it to the server
+    too, with the MIT-SHM extension `ext`. Returns (shmid, address, shmseg),
+    or None if that isn't possible, e.g. because the server is remote.
+
+    If `remove`, the segment is marked for removal straight away, so it goes
+    away once both we and the server detach; otherwise that is up to whoever
+    ends up with it. """
+    segment = create_segment(size)
+    if segment is None:
+        return None
+    shmid, addr = segment
+
+    shmseg = conn.generate_id()
+    try:
+        ext.Attach(shmseg, shmid, False, is_checked=True).check()
+    except Error:
+        # e.g. a remote server, which can't see our segment.
+        C.shmdt(addr)
+        C.shmctl(shmid, C.IPC_RMID, ffi.NULL)
+        return None
+    if remove:
+        C.shmctl(shmid, C.IPC_RMID, ffi.NULL)
+    return shmid, addr, shmseg
+
+
+def detach_segment(conn, ext, shmseg, addr):
+    """ Detach a segment from `attach_segment` from the server and from this
+    process. """
+    ext.Detach(shmseg)
+    conn.flush()
+    C.shmdt(addr)
+
+
+class SharedImage(object):
+    """ A ZPixmap image buffer of a fixed size and depth which can be
+    transferred to and from the server as a whole frame.
+
+    When the server supports MIT-SHM (i.e. it is local and has the extension),
+    the buffer is a SysV shared memory segment attached to the server, and
+    frames never go through the socket. Otherwise, the buffer is an ordinary
+    bytearray and frames are moved with (pipelined) core GetImage/PutImage
+    requests, split into bands that fit in the maximum request length.
+
+    Either way, `buf` is a writable memoryview of the frame and `array()`
+    returns a numpy view of it.
+    """
+
+    def __init__(self, conn, width, height, depth, use_shm=True):
+        self.conn = conn
+        self.width = width
+        self.height = height
+        self.depth = depth
+        self.stride = image_stride(conn.setup, depth, width)
+        self.size = self.stride * height
+
+        self.shm = False
+        self.shmseg = None
+        self._addr = None
+        self.closed = False
+        self.ext = conn(shm.key)
+        if use_shm and self.ext.present:
+            self.shm = self._attach()
+        if not self.shm:
+            self.buf = memoryview(bytearray(self.size))
+
+    def _attach(self):
+        segment = attach_segment(self.conn, self.ext, self.size)
+        if segment is None:
+            return False
+        _, self._addr, self.shmseg = segment
+        self.buf = memoryview(ffi.buffer(self._addr, self.size))
+        return True
+
+    def _check_open(self):
+        if self.closed:
+            raise XcffibException("SharedImage is closed")
+
+    def array(self):
+        """ Return a numpy view of the frame; see `image_array`. """
+        self._check_open()
+        return image_array(self.conn.setup, self.depth, self.buf, self.width,
+                           self.height)
+
+    def _bands(self):
+        """ Yield (first row, number of rows) pairs splitting the frame into
+        pieces that fit in one request. """
+        # 4 byte units; leave room for the PutImage header.
+        maxlen = self.conn.get_maximum_request_length() * 4 - 24
+        rows = max(1, maxlen // self.stride)
+        for row in range(0, self.height, rows):
+            yield row, min(rows, self.height - row)
+
+    def get_image_shm(self, drawable, x=0, y=0, plane_mask=0xffffffff):
+        """ Read the area of `drawable` at (x, y) into the frame buffer and
+        return `buf`. """
+        self._check_open()
+        fmt = xproto.ImageFormat.ZPixmap
+        if self.shm:
+            self.ext.GetImage(drawable, x, y, self.width, self.height,
+                              plane_mask, fmt, self.shmseg, 0).reply()
+            return self.buf
+
+        cookies = [(row, rows, self.conn.core.GetImage(fmt, drawable, x,
+                                                       y + row, self.width,
+                                                       rows, plane_mask))
+                   for row, rows in self._bands()]
+        for row, rows, cookie in cookies:
+            size = rows * self.stride
+            start = row * self.stride
+            self.buf[start:start + size] = cookie.reply().data.raw[:size]
+        return self.buf
+
+    def put_image_shm(self, drawable, gc, x=0, y=0, send_event=False):
+        """ Draw the frame buffer onto `drawable` at (x, y).
+
+        With MIT-SHM the server reads the buffer asynchronously, so don't
+        modify it until the request has been processed; pass `send_event` to
+        get a shm.CompletionEvent when it has, or make a round trip. """
+        self._check_open()
+        fmt = xproto.ImageFormat.ZPixmap
+        if self.shm:
+            return self.ext.PutImage(drawable, gc, self.width, self.height,
+                                     0, 0, self.width, self.height, x, y,
+                                     self.depth, fmt, send_event, self.shmseg,
+                                     0)
+
+        cookie = None
+        for row, rows in self._bands():
+            start = row * self.stride
+            data = self.buf[start:start + rows * self.stride]
+            cookie = self.conn.core.PutImage(fmt, drawable, gc, self.width,
+                                             rows, x, y + row, 0, self.depth,
+                                             data)
+        return cookie
+
+    def close(self):
+        """ Detach the shared memory segment, if any. The image can't be
+        used afterwards. """
+        if self.shm:
+            if hasattr(self.buf, "release"):
+                self.buf.release()
+            detach_segment(self.conn, self.ext, self.shmseg, self._addr)
+            self.shm = False
+            self._addr = None
+        self.buf = None
+        self.closed = True
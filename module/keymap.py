@@ -0,0 +1,108 @@
+# A client side copy of the keyboard and modifier mappings.
+
+import array
+
+from . import xproto
+
+# An array typecode for 32 bit keysyms.
+_KEYSYM = 'I' if array.array('I').itemsize == 4 else 'L'
+
+
+class Keymap(object):
+    """ The keyboard mapping (keycode to keysyms) and modifier mapping of a
+    connection, fetched once and kept in flat arrays.
+
+    Lookups in either direction are constant time. The maps are refetched
+    lazily (on the next lookup) after a MappingNotify event is decoded on the
+    connection; note that the server sends MappingNotify to every client, no
+    event selection is needed.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.min_keycode = conn.setup.min_keycode
+        self.max_keycode = conn.setup.max_keycode
+        self._keyboard_stale = True
+        self._modifiers_stale = True
+        self.refresh()
+        conn.add_event_watcher(self._event)
+
+    def close(self):
+        self.conn.remove_event_watcher(self._event)
+
+    def refresh(self):
+        """ Refetch whatever is stale, in one round trip. """
+        keyboard = modifiers = None
+        if self._keyboard_stale:
+            count = self.max_keycode - self.min_keycode + 1
+            keyboard = self.conn.core.GetKeyboardMapping(self.min_keycode,
+                                                         count)
+        if self._modifiers_stale:
+            modifiers = self.conn.core.GetModifierMapping()
+
+        if keyboard is not None:
+            self._set_keyboard(keyboard.reply())
+        if modifiers is not None:
+            self._set_modifiers(modifiers.reply())
+
+    def _set_keyboard(self, reply):
+        self.keysyms_per_keycode = per = reply.keysyms_per_keycode
+        self._keysyms = array.array(_KEYSYM, reply.keysyms)
+
+        self._keycodes = {}
+        for i, keysym in enumerate(self._keysyms):
+            if keysym == 0:  # NoSymbol
+                continue
+            keycode = self.min_keycode + i // per
+            keycodes = self._keycodes.setdefault(keysym, [])
+            if keycode not in keycodes:
+                keycodes.append(keycode)
+        self._keyboard_stale = False
+
+    def _set_modifiers(self, reply):
+        per = reply.keycodes_per_modifier
+        keycodes = list(reply.keycodes)
+        self.modifiers = [tuple(k for k in keycodes[i * per:(i + 1) * per] if k)
+                          for i in range(8)]
+
+        self._modifier_masks = {}
+        for i, keycodes in enumerate(self.modifiers):
+            for keycode in keycodes:
+                self._modifier_masks[keycode] = \
+                    self._modifier_masks.get(keycode, 0) | (1 << i)
+        self._modifiers_stale = False
+
+    def _check(self):
+        if self._keyboard_stale or self._modifiers_stale:
+            self.refresh()
+
+    def keysyms(self, keycode):
+        """ Return all the keysyms bound to `keycode`, one per column. """
+        self._check()
+        if not self.min_keycode <= keycode <= self.max_keycode:
+            return self._keysyms[:0]
+        start = (keycode - self.min_keycode) * self.keysyms_per_keycode
+        return self._keysyms[start:start + self.keysyms_per_keycode]
+
+    def keysym(self, keycode, column=0):
+        """ Return the keysym in `column` for `keycode`, or 0 (NoSymbol). """
+        keysyms = self.keysyms(keycode)
+        return keysyms[column] if column < len(keysyms) else 0
+
+    def keycodes(self, keysym):
+        """ Return the keycodes which have `keysym` in any column. """
+        self._check()
+        return self._keycodes.get(keysym, [])
+
+    def modifier_mask(self, keycode):
+        """ Return the xproto.ModMask of the modifiers `keycode` is bound to,
+        or 0 if it isn't a modifier. """
+        self._check()
+        return self._modifier_masks.get(keycode, 0)
+
+    def _event(self, event):
+        if isinstance(event, xproto.MappingNotifyEvent):
+            if event.request == xproto.Mapping.Keyboard:
+                self._keyboard_stale = True
+            elif event.request == xproto.Mapping.Modifier:
+                self._modifiers_stale = True
@@ -0,0 +1,296 @@
+# Spreading requests (and the decoding of their replies) over several
+# processes, each with its own connection.
+
+import collections
+import multiprocessing
+import threading
+
+from . import Connection, XcffibException, Error
+from .ffi import ffi, C
+from . import xproto
+from . import shm
+from .image import image_array, create_segment, attach_segment, \
+    detach_segment
+from .properties import iter_property
+from .tree import snapshot
+
+# A result that was left in a SysV shared memory segment for the parent.
+_Segment = collections.namedtuple("_Segment", ["shmid", "size"])
+
+# The worker's own connection, and the size from which results are returned
+# through shared memory.
+_conn = None
+_threshold = None
+
+
+def _init_worker(display, auth, threshold):
+    global _conn, _threshold
+    _conn = Connection(display, auth=auth)
+    _threshold = threshold
+
+
+def _export(data):
+    """ Return `data` as is if it is small, otherwise copy it into a shared
+    memory segment and return that instead. Segments handed to the parent
+    aren't marked for removal; it does that once it has attached them, or
+    when the result is dropped without being collected. """
+    segment = None
+    if len(data) >= _threshold:
+        segment = create_segment(len(data))
+    if segment is None:
+        return bytes(data)
+    shmid, addr = segment
+    ffi.buffer(addr, len(data))[:] = data
+    C.shmdt(addr)
+    return _Segment(shmid, len(data))
+
+
+def _get_image_shm(ext, drawable, x, y, width, height, plane_mask):
+    # An upper bound on the size of the image: 32 bits per pixel, which is
+    # always padded to a whole scanline.
+    # (not removed yet, since the parent still has to attach it)
+    segment = attach_segment(_conn, ext, width * height * 4, remove=False)
+    if segment is None:
+        return None
+    shmid, addr, seg = segment
+    try:
+        reply = ext.GetImage(drawable, x, y, width, height, plane_mask,
+                             xproto.ImageFormat.ZPixmap, seg, 0).reply()
+    except Error:
+        C.shmctl(shmid, C.IPC_RMID, ffi.NULL)
+        raise
+    finally:
+        detach_segment(_conn, ext, seg, addr)
+    return reply.depth, reply.visual, _Segment(shmid, reply.size)
+
+
+def _get_image(drawable, x, y, width, height, plane_mask):
+    # The server writes large images straight into the segment we hand to
+    # the parent, if it can.
+    ext = _conn(shm.key)
+    if width * height * 4 >= _threshold and ext.present:
+        result = _get_image_shm(ext, drawable, x, y, width, height,
+                                plane_mask)
+        if result is not None:
+            return result
+
+    reply = _conn.core.GetImage(xproto.ImageFormat.ZPixmap, drawable, x, y,
+                                width, height, plane_mask).reply()
+    return reply.depth, reply.visual, _export(reply.data.raw)
+
+
+def _get_property(window, property, type, delete):
+    typ = fmt = 0
+    data = bytearray()
+    for typ, fmt, chunk in iter_property(_conn, window, property, type,
+                                         delete):
+        data += chunk
+    return typ, fmt, _export(data)
+
+
+def _snapshot(root, properties, property_length):
+    return snapshot(_conn, root, properties, property_length)
+
+
+def _apply(func, args):
+    return func(_conn, *args)
+
+
+class SharedBuffer(object):
+    """ A result that came back from a worker in shared memory. `buf` is a
+    memoryview of it. The memory is freed by close(), or when the buffer is
+    garbage collected. """
+
+    def __init__(self, segment):
+        self.size = segment.size
+        self._addr = C.shmat(segment.shmid, ffi.NULL, 0)
+        # Either way, the segment is gone once we detach.
+        C.shmctl(segment.shmid, C.IPC_RMID, ffi.NULL)
+        if self._addr == ffi.cast("void *", -1):
+            self._addr = None
+            raise XcffibException("shmat failed")
+        self.buf = memoryview(ffi.buffer(self._addr, self.size))
+
+    def __len__(self):
+        return self.size
+
+    def tobytes(self):
+        return self.buf.tobytes()
+
+    def close(self):
+        if self._addr is not None:
+            if hasattr(self.buf, "release"):
+                self.buf.release()
+            self.buf = None
+            C.shmdt(self._addr)
+            self._addr = None
+
+    def __del__(self):
+        self.close()
+
+
+def _segments(result):
+    """ The _Segments in a result from a worker. """
+    if not isinstance(result, tuple):
+        return []
+    return [data for data in result if isinstance(data, _Segment)]
+
+
+def _remove_segment(segment):
+    C.shmctl(segment.shmid, C.IPC_RMID, ffi.NULL)
+
+
+class ImageResult(object):
+    """ A ZPixmap image fetched by a worker. `data` is bytes, or a
+    SharedBuffer for large images. """
+
+    def __init__(self, setup, depth, visual, width, height, data):
+        self.setup = setup
+        self.depth = depth
+        self.visual = visual
+        self.width = width
+        self.height = height
+        self.data = data
+
+    def array(self):
+        """ Return a numpy view of the image; see image.image_array. """
+        data = self.data
+        if isinstance(data, SharedBuffer):
+            data = data.buf
+        return image_array(self.setup, self.depth, data, self.width,
+                           self.height)
+
+    def close(self):
+        if isinstance(self.data, SharedBuffer):
+            self.data.close()
+
+
+class PoolResult(object):
+    """ The pending result of something submitted to a WorkerPool. """
+
+    def __init__(self, pool, async_result, convert):
+        self._pool = pool
+        self._result = async_result
+        self._convert = convert
+        self._collected = False
+
+    def ready(self):
+        return self._result.ready()
+
+    def get(self, timeout=None):
+        """ Wait for and return the result; exceptions raised in the worker
+        are raised here. Results which come back in shared memory have to be
+        collected before the pool is closed; the memory of the ones which
+        aren't is freed then (or when the PoolResult is dropped, if it has
+        arrived). """
+        result = self._result.get(timeout)
+        self._collected = True
+        return self._convert(result)
+
+    def __del__(self):
+        if (not self._collected and self._result.ready() and
+                self._result.successful()):
+            self._pool._remove(self._result.get())
+
+
+class WorkerPool(object):
+    """ A pool of worker processes, each of which has its own connection to
+    the same display (and with the same auth) as `conn`, for spreading
+    requests and the decoding of their replies over several cores.
+
+    Work is submitted with get_image, get_property, snapshot or submit, each
+    of which returns a PoolResult. Images and property values of at least
+    `threshold` bytes come back through SysV shared memory rather than being
+    pickled; with MIT-SHM, the server writes images directly into it.
+
+    The workers are started with the "spawn" method where available, since
+    an xcb connection can't survive a fork. This doesn't work for
+    connections made with Connection(fd=...).
+    """
+
+    def __init__(self, conn, processes=None, threshold=64 * 1024):
+        self.setup = conn.setup
+        if hasattr(multiprocessing, "get_context"):
+            context = multiprocessing.get_context("spawn")
+        else:
+            context = multiprocessing
+        self._pool = context.Pool(processes, _init_worker,
+                                  (conn.display, conn.auth, threshold))
+
+        # The shared memory segments which workers have handed us, but
+        # nobody has collected (and so marked for removal) yet.
+        self._segments = set()
+        self._lock = threading.Lock()
+
+    def _apply_async(self, func, args, convert):
+        return PoolResult(self, self._pool.apply_async(func, args,
+                                                       callback=self._track),
+                          convert)
+
+    def _track(self, result):
+        # Called in the pool's result handler thread.
+        with self._lock:
+            self._segments.update(_segments(result))
+
+    def _import(self, data):
+        if isinstance(data, _Segment):
+            with self._lock:
+                self._segments.discard(data)
+            return SharedBuffer(data)
+        return data
+
+    def _remove(self, result):
+        with self._lock:
+            segments = self._segments.intersection(_segments(result))
+            self._segments.difference_update(segments)
+        for segment in segments:
+            _remove_segment(segment)
+
+    def submit(self, func, *args):
+        """ Run `func(conn, *args)` in a worker, where `conn` is that
+        worker's connection. `func`, `args` and the result have to be
+        picklable. """
+        return self._apply_async(_apply, (func, args), lambda result: result)
+
+    def get_image(self, drawable, x, y, width, height,
+                  plane_mask=0xffffffff):
+        """ Fetch a ZPixmap image of an area of `drawable`; the result is an
+        ImageResult. """
+        def convert(result):
+            depth, visual, data = result
+            return ImageResult(self.setup, depth, visual, width, height,
+                               self._import(data))
+        args = (drawable, x, y, width, height, plane_mask)
+        return self._apply_async(_get_image, args, convert)
+
+    def get_property(self, window, property,
+                     type=xproto.GetPropertyType.Any, delete=False):
+        """ Read the whole of a property; the result is a (type, format,
+        data) tuple, where data is bytes or a SharedBuffer. """
+        def convert(result):
+            typ, fmt, data = result
+            return typ, fmt, self._import(data)
+        args = (window, property, type, delete)
+        return self._apply_async(_get_property, args, convert)
+
+    def snapshot(self, root=None, properties=(xproto.Atom.WM_NAME,),
+                 property_length=256):
+        """ Take a tree.snapshot() in a worker. """
+        args = (root, properties, property_length)
+        return self._apply_async(_snapshot, args, lambda result: result)
+
+    def close(self):
+        """ Wait for the outstanding work, and stop the workers. The shared
+        memory of results which haven't been collected is freed. """
+        self._pool.close()
+        self._pool.join()
+        with self._lock:
+            segments, self._segments = self._segments, set()
+        for segment in segments:
+            _remove_segment(segment)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
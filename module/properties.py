@@ -0,0 +1,173 @@
+# Helpers for reading window properties.
+
+import collections
+
+import six
+
+from . import xproto
+
+
+def property_value(unpacker):
+    """ Parse a raw GetProperty reply (as returned by Cookie.raw_reply)
+    without decoding the value into an xcffib.List. Returns (type, format,
+    bytes_after, data), where data is a memoryview over the reply buffer. """
+    fmt, typ, bytes_after, value_len = unpacker.unpack("xB2x4xIII12x")
+    size = value_len * fmt // 8
+    data = memoryview(unpacker.buf)[unpacker.offset:unpacker.offset + size]
+    return typ, fmt, bytes_after, data
+
+
+def iter_property(conn, window, property, type=xproto.GetPropertyType.Any,
+                  delete=False, chunk_size=64 * 1024, pipeline=4):
+    """ Read a (possibly very large) property in chunks. This yields
+    (type, format, data) tuples, where data is a memoryview directly over the
+    reply buffer of at most `chunk_size` bytes.
+
+    Successive GetProperty requests with increasing long_offset are kept in
+    flight, at most `pipeline` at a time, so memory use is bounded by
+    roughly `chunk_size * pipeline` no matter how large the property is.
+    Replies are not decoded into xcffib.List objects.
+
+    If `delete` is True, the server deletes the property once the last chunk
+    has been read. If the property isn't of `type`, nothing is yielded.
+    """
+    # GetProperty offsets and lengths are in 4 byte units.
+    length = max(1, chunk_size // 4)
+    pending = collections.deque()
+
+    def request(offset):
+        pending.append(conn.core.GetProperty(delete, window, property, type,
+                                             offset, length))
+
+    request(0)
+    next_offset = length
+    end = None
+
+    try:
+        while pending:
+            unpacker = pending.popleft().raw_reply()
+            typ, fmt, bytes_after, data = property_value(unpacker)
+
+            if end is None:
+                if (type != xproto.GetPropertyType.Any and typ != type) or \
+                        (len(data) == 0 and bytes_after > 0):
+                    # The type didn't match: bytes_after is the size of the
+                    # whole property, but none of it will be sent.
+                    return
+                end = (len(data) + bytes_after + 3) // 4
+            while next_offset < end and len(pending) < pipeline:
+                request(next_offset)
+                next_offset += length
+
+            if len(data) > 0:
+                yield typ, fmt, data
+    finally:
+        # Don't leave replies queued in libxcb if we were abandoned early.
+        for cookie in pending:
+            cookie.discard()
+
+
+class PropertyCache(object):
+    """ A read through cache of window properties, kept up to date by
+    PropertyNotify and DestroyNotify events.
+
+    The first time a window's properties are read through the cache, the
+    cache adds PropertyChange and StructureNotify to the events this client
+    selects on that window (pass `select=False` if you already select them
+    yourself). From then on the cache invalidates entries as the
+    corresponding events are decoded, so it is only as fresh as your event
+    loop: events still sitting unread in the queue haven't been seen yet.
+
+    At most `max_entries` properties and `max_bytes` bytes of property data
+    are kept; the least recently used entries are evicted first.
+    """
+
+    def __init__(self, conn, max_entries=4096, max_bytes=4 * 1024 * 1024,
+                 select=True):
+        self.conn = conn
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.select = select
+        self.size = 0
+        self._entries = collections.OrderedDict()
+        self._windows = {}
+        conn.add_event_watcher(self._event)
+
+    def close(self):
+        self.conn.remove_event_watcher(self._event)
+        self.clear()
+
+    def clear(self):
+        self._entries.clear()
+        self._windows.clear()
+        self.size = 0
+
+    def _watch(self, window):
+        if window in self._windows:
+            return
+        if self.select:
+            attrs = self.conn.core.GetWindowAttributes(window).reply()
+            mask = (attrs.your_event_mask | xproto.EventMask.PropertyChange |
+                    xproto.EventMask.StructureNotify)
+            if mask != attrs.your_event_mask:
+                self.conn.core.ChangeWindowAttributes(
+                    window, xproto.CW.EventMask, [mask])
+        self._windows[window] = set()
+
+    def _store(self, window, atom, value):
+        key = (window, atom)
+        self._drop(key)
+        self._entries[key] = value
+        self._windows.setdefault(window, set()).add(atom)
+        if value is not None:
+            self.size += len(value[2])
+
+        while self._entries and (len(self._entries) > self.max_entries or
+                                 self.size > self.max_bytes):
+            key, _ = next(iter(self._entries.items()))
+            self._drop(key)
+
+    def _drop(self, key):
+        value = self._entries.pop(key, None)
+        if value is not None:
+            self.size -= len(value[2])
+        atoms = self._windows.get(key[0])
+        if atoms is not None:
+            atoms.discard(key[1])
+            if not atoms:
+                # Forget the window too, or every window ever read would
+                # stay in _windows. Reading it again selects its events again.
+                del self._windows[key[0]]
+
+    def get(self, window, atom):
+        """ Return (type, format, bytes) for the property `atom` on `window`,
+        or None if it isn't set. """
+        key = (window, atom)
+        if key in self._entries:
+            # move it to the most recently used end
+            value = self._entries.pop(key)
+            self._entries[key] = value
+            return value
+
+        self._watch(window)
+        chunks = list(iter_property(self.conn, window, atom))
+        if chunks:
+            typ, fmt, _ = chunks[0]
+            value = (typ, fmt, six.b("").join(c.tobytes() for _, _, c in chunks))
+        else:
+            value = None
+        self._store(window, atom, value)
+        return value
+
+    def _event(self, event):
+        if isinstance(event, xproto.PropertyNotifyEvent):
+            if event.window not in self._windows:
+                return
+            if event.state == xproto.Property.Delete:
+                self._store(event.window, event.atom, None)
+            else:
+                self._drop((event.window, event.atom))
+        elif isinstance(event, xproto.DestroyNotifyEvent):
+            atoms = self._windows.pop(event.window, None)
+            for atom in atoms or ():
+                self._drop((event.window, atom))
@@ -0,0 +1,149 @@
+# Record the raw events, replies and errors a connection decodes, and replay
+# them through the same decoding path later without an X server. This is
+# mostly useful for benchmarking and regression testing the decoders.
+
+import importlib
+import mmap
+import struct
+
+import six
+
+import xcffib
+from .ffi import ffi
+
+MAGIC = six.b("XCFFREC2")
+
+EVENT = 1
+REPLY = 2
+ERROR = 3
+# Gives the class name that records with this index refer to from here on.
+NAME = 4
+
+# kind, index of the type name (0 for none), length of the data
+_header = struct.Struct("=BxHI")
+
+# Events and errors are always 32 bytes on the wire; the extra full_sequence
+# xcb tacks on isn't needed to decode them.
+_EVENT_SIZE = 32
+
+# ...except for GenericEvents, which have `length` more 4 byte units, which
+# libxcb puts after full_sequence.
+_GE_EVENT = 35
+_GE_LENGTH = struct.Struct("=4xI")
+
+
+def _qualname(typ):
+    return six.b(typ.__module__ + "." + typ.__name__)
+
+
+class Recorder(object):
+    """ Append everything a connection decodes to the file at `path`. Use it
+    by setting `conn.recorder = Recorder(path)`.
+
+    The file is a magic number followed by records, each of which is a
+    header (kind, name index, data length) and the raw data. Replies and
+    events refer to their class by an index, which a NAME record (whose data
+    is the qualified name of the class) has given it earlier in the file.
+    """
+
+    def __init__(self, path):
+        self.file = open(path, 'ab')
+        if self.file.tell() == 0:
+            self.file.write(MAGIC)
+        self._names = {}
+
+    def _write(self, kind, data, index=0):
+        self.file.write(_header.pack(kind, index, len(data)))
+        self.file.write(data)
+
+    def _name(self, typ):
+        index = self._names.get(typ)
+        if index is None:
+            index = self._names[typ] = len(self._names) + 1
+            self._write(NAME, _qualname(typ), index)
+        return index
+
+    def record_event(self, e, event_type):
+        size = _EVENT_SIZE
+        if e.response_type & 0x7f == _GE_EVENT:
+            length, = _GE_LENGTH.unpack(ffi.buffer(e, _GE_LENGTH.size))
+            size = ffi.sizeof("xcb_generic_event_t") + 4 * length
+        # Extension events can only be told apart with the connection's
+        # first_event numbers, so record which class it was.
+        self._write(EVENT, ffi.buffer(e, size), self._name(event_type))
+
+    def record_error(self, e):
+        self._write(ERROR, ffi.buffer(e, _EVENT_SIZE))
+
+    def record_reply(self, reply_type, unpacker):
+        self._write(REPLY, ffi.buffer(unpacker.cdata, unpacker.known_max),
+                    self._name(reply_type))
+
+    def close(self):
+        self.file.close()
+
+
+class Replayer(object):
+    """ Decode a file written by a Recorder. The file is mmapped and each
+    record is decoded in place, through the same classes the connection would
+    have used.
+
+    Decoded objects may refer to the mapping, so keep the Replayer around
+    while you use them.
+    """
+
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        # ACCESS_COPY rather than ACCESS_READ, since cffi wants a writable
+        # buffer; pages are only copied if something writes to them.
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_COPY)
+        if self.map[:len(MAGIC)] != MAGIC:
+            raise xcffib.XcffibException("%s is not a recording" % path)
+        self._types = {}
+
+    def records(self):
+        """ Yield (kind, type name, memoryview of the data) for each
+        record, other than NAME records. """
+        view = memoryview(self.map)
+        offset = len(MAGIC)
+        end = len(self.map)
+        # A recording may have been appended to, by a Recorder which numbered
+        # the names all over again.
+        names = {0: six.b("")}
+        while offset < end:
+            kind, index, data_len = _header.unpack_from(self.map, offset)
+            offset += _header.size
+            if kind == NAME:
+                names[index] = self.map[offset:offset + data_len]
+            else:
+                yield kind, names[index], view[offset:offset + data_len]
+            offset += data_len
+
+    def _type(self, name):
+        typ = self._types.get(name)
+        if typ is None:
+            module, cls = name.decode('ascii').rsplit('.', 1)
+            typ = getattr(importlib.import_module(module), cls)
+            self._types[name] = typ
+        return typ
+
+    def decode(self, kind, name, data):
+        """ Decode one record. Errors are returned, not raised. """
+        cdata = ffi.from_buffer(data)
+        response_type = six.indexbytes(data, 0)
+        if kind == REPLY:
+            unpacker = xcffib.Unpacker(cdata, known_max=len(data))
+            return self._type(name)(unpacker)
+        elif kind == ERROR or response_type == 0:
+            error = xcffib.core_errors[six.indexbytes(data, 1)]
+            return error(xcffib.Unpacker(cdata))
+        else:
+            return self._type(name)(xcffib.Unpacker(cdata))
+
+    def __iter__(self):
+        for record in self.records():
+            yield self.decode(*record)
+
+    def close(self):
+        self.map.close()
+        self.file.close()
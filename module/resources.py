@@ -0,0 +1,417 @@
+# Helpers for managing server side resources.
+
+import collections
+import time
+
+from . import XcffibException
+from . import xc_misc
+from . import xproto
+from . import render
+
+
+class XidAllocator(object):
+    """ Hands out resource ids for a connection, in bulk.
+
+    Ids given back with `free` (after you have sent the request that destroys
+    the resource, e.g. FreePixmap) are reused first. Fresh ids come from
+    libxcb, which asks XC-MISC for a new range when the current one runs out.
+
+    Once libxcb has run out too, the allocator takes over: it asks XC-MISC
+    for ranges itself (GetXIDRange), and then for ids which are unused but
+    scattered throughout the client's id space (GetXIDList), which libxcb
+    never does. libxcb isn't asked again after that, since XC-MISC could give
+    it ids that are also in the free list.
+
+    An id is never handed out again until it has been freed, even when
+    XC-MISC reports it as unused because the request creating it hasn't
+    reached the server yet.
+    """
+
+    # libxcb's answer when it is out of ids.
+    _EXHAUSTED = 0xffffffff
+
+    def __init__(self, conn):
+        self.conn = conn
+        self._free = []
+        # Ids which have been handed out and not freed since. The server
+        # reports an id as unused until the request creating it has got
+        # there, so XC-MISC (and libxcb, which asks it) may offer these again.
+        self._live = set()
+        self._exhausted = False
+        # The rest of the last range from GetXIDRange: (next id, count).
+        self._range = (0, 0)
+        mask = conn.setup.resource_id_mask
+        self._inc = mask & -mask
+
+    def generate_id(self):
+        return self.generate_ids(1)[0]
+
+    def generate_ids(self, n):
+        """ Return a list of `n` ids. """
+        reuse = len(self._free) - min(n, len(self._free))
+        ids = self._free[reuse:]
+        del self._free[reuse:]
+        self._live.update(ids)
+
+        # Anything left in the free list was taken above, so only the live
+        # ids need to be kept out of what comes back from here on.
+        while len(ids) < n and not self._exhausted:
+            fresh = self.conn.generate_ids(n - len(ids))
+            if fresh and fresh[-1] == self._EXHAUSTED:
+                fresh.pop()
+                self._exhausted = True
+            ids.extend(self._take(fresh, len(fresh)))
+
+        if len(ids) < n:
+            try:
+                ids.extend(self._recover(n - len(ids)))
+            except XcffibException:
+                self.free(*ids)
+                raise
+        return ids
+
+    def _take(self, candidates, n):
+        """ Mark up to `n` of `candidates` which aren't live as live, and
+        return them. """
+        taken = []
+        for xid in candidates:
+            if len(taken) == n:
+                break
+            if xid not in self._live:
+                self._live.add(xid)
+                taken.append(xid)
+        return taken
+
+    def _recover(self, n):
+        ext = self.conn(xc_misc.key)
+        if not ext.present:
+            raise XcffibException("Out of resource ids and no XC-MISC")
+
+        recovered = []
+        while len(recovered) < n:
+            start, count = self._range
+            if count == 0:
+                reply = ext.GetXIDRange().reply()
+                # The server's answer when it has no range left is 0, 1.
+                if reply.start_id == 0 or reply.count == 0:
+                    break
+                start, count = reply.start_id, reply.count
+            self._range = (start + self._inc, count - 1)
+            recovered.extend(self._take([start], 1))
+
+        # There are no ranges left, so look for scattered ids. The server
+        # lists unused ids in order, some of which may be live; ask for more
+        # until there are enough which aren't, or it has no more.
+        want = n - len(recovered)
+        while want:
+            scattered = ext.GetXIDList(want).reply().ids
+            need = n - len(recovered)
+            recovered.extend(self._take(scattered, need))
+            if len(recovered) == n or len(scattered) < want:
+                break
+            want *= 2
+
+        if len(recovered) < n:
+            self.free(*recovered)
+            raise XcffibException("Out of resource ids")
+        return recovered
+
+    def free(self, *xids):
+        """ Make `xids` available for reuse. Only do this after the requests
+        freeing the corresponding resources have been sent. """
+        self._live.difference_update(xids)
+        self._free.extend(xids)
+
+
+# What the attributes of a new GC are, for the ones which can be put back.
+# Tile, Stipple and Font can't: there is no way of naming their defaults.
+_GC_DEFAULTS = {
+    xproto.GC.Function: xproto.GX.copy,
+    xproto.GC.PlaneMask: 0xffffffff,
+    xproto.GC.Foreground: 0,
+    xproto.GC.Background: 1,
+    xproto.GC.LineWidth: 0,
+    xproto.GC.LineStyle: 0,  # Solid
+    xproto.GC.CapStyle: xproto.CapStyle.Butt,
+    xproto.GC.JoinStyle: 0,  # Miter
+    xproto.GC.FillStyle: 0,  # Solid
+    xproto.GC.FillRule: 0,  # EvenOdd
+    xproto.GC.TileStippleOriginX: 0,
+    xproto.GC.TileStippleOriginY: 0,
+    xproto.GC.SubwindowMode: 0,  # ClipByChildren
+    xproto.GC.GraphicsExposures: 1,
+    xproto.GC.ClipOriginX: 0,
+    xproto.GC.ClipOriginY: 0,
+    xproto.GC.ClipMask: 0,  # None
+    xproto.GC.DashOffset: 0,
+    xproto.GC.DashList: 4,
+    xproto.GC.ArcMode: xproto.ArcMode.PieSlice,
+}
+
+# Likewise for render pictures.
+_PICTURE_DEFAULTS = {
+    render.CP.Repeat: 0,
+    render.CP.AlphaMap: 0,
+    render.CP.AlphaXOrigin: 0,
+    render.CP.AlphaYOrigin: 0,
+    render.CP.ClipXOrigin: 0,
+    render.CP.ClipYOrigin: 0,
+    render.CP.ClipMask: 0,
+    render.CP.GraphicsExposure: 1,
+    render.CP.SubwindowMode: 0,
+    render.CP.PolyEdge: 0,
+    render.CP.PolyMode: 0,
+    render.CP.Dither: 0,
+    render.CP.ComponentAlpha: 0,
+}
+
+
+def _changes(current, wanted, defaults):
+    """ Return the {bit: value} changes which turn a resource with the
+    non-default attributes `current` into one with `wanted`, or None if that
+    isn't possible. """
+    changes = {}
+    for bit in set(current) | set(wanted):
+        if bit in wanted:
+            value = wanted[bit]
+        elif bit in defaults:
+            value = defaults[bit]
+        else:
+            return None
+        if current.get(bit, defaults.get(bit)) != value:
+            changes[bit] = value
+    return changes
+
+
+def _value_list(values):
+    """ Split a {bit: value} dict into a value mask and list. """
+    bits = sorted(values)
+    return sum(bits), [values[bit] for bit in bits]
+
+
+def _size_class(n):
+    """ Round a pixmap dimension up to the size class it is pooled in. """
+    return max(16, 1 << (n - 1).bit_length())
+
+
+class _Resource(object):
+
+    __slots__ = ('kind', 'xid', 'key', 'values', 'width', 'height', 'nbytes',
+                 'pixmap', 'idle_since')
+
+    def __init__(self, kind, xid, key, values=None, width=0, height=0,
+                 nbytes=0, pixmap=None):
+        self.kind = kind
+        self.xid = xid
+        self.key = key
+        self.values = values
+        self.width = width
+        self.height = height
+        self.nbytes = nbytes
+        self.pixmap = pixmap
+        self.idle_since = None
+
+
+class ResourcePool(object):
+    """ Reuses GCs, pixmaps and render pictures instead of creating and
+    freeing them over and over.
+
+    Resources are taken with `gc`, `pixmap` and `picture`, and handed back
+    with `release` instead of being freed. A taken resource is one that was
+    released before if there is a suitable one:
+
+    - GCs are pooled by depth. A GC with the requested values is preferred;
+      otherwise one ChangeGC request sets just the attributes that differ
+      (putting the ones that were set before but not asked for now back to
+      their defaults).
+    - Pixmaps are pooled by depth and size class: dimensions are rounded up
+      to a power of two (at least 16), so you may get a bigger pixmap than
+      you asked for, with arbitrary contents. `size()` tells you how big.
+    - Pictures are pooled by format, depth and size class along with the
+      pixmap they are on, and their attributes are reset like GCs'.
+
+    Released resources are really freed when there are more than
+    `max_idle` of them, when idle pixmaps take more than `max_idle_bytes`,
+    or when they have been idle for `max_age` seconds; the oldest go first.
+    Ids come from (and go back to) `xids`, an XidAllocator.
+    """
+
+    def __init__(self, conn, max_idle=64, max_idle_bytes=16 * 1024 * 1024,
+                 max_age=30.0, xids=None):
+        self.conn = conn
+        self.max_idle = max_idle
+        self.max_idle_bytes = max_idle_bytes
+        self.max_age = max_age
+        self.xids = xids if xids is not None else XidAllocator(conn)
+        screen = conn.setup.roots[conn.pref_screen]
+        self.root = screen.root
+        self.root_depth = screen.root_depth
+        self._render = None
+
+        self.idle_bytes = 0
+        # xid -> _Resource, oldest first
+        self._idle = collections.OrderedDict()
+        # key -> idle _Resources, most recently released last
+        self._by_key = {}
+        self._busy = {}
+
+    @property
+    def render(self):
+        if self._render is None:
+            self._render = self.conn(render.key)
+        return self._render
+
+    def _take(self, key):
+        """ Return the idle resources for `key`, most recently used last. """
+        return self._by_key.get(key, [])
+
+    def _use(self, res):
+        self._by_key[res.key].remove(res)
+        del self._idle[res.xid]
+        self.idle_bytes -= res.nbytes
+        res.idle_since = None
+        self._busy[res.xid] = res
+        return res.xid
+
+    def gc(self, depth=None, values=None):
+        """ Return a GC for drawables of `depth` (by default, the root
+        window's) whose non-default attributes are `values`, a dict mapping
+        xproto.GC bits to values. """
+        depth = self.root_depth if depth is None else depth
+        values = dict(values or {})
+        best = None
+        for res in reversed(self._take(("gc", depth))):
+            changes = _changes(res.values, values, _GC_DEFAULTS)
+            if changes is not None and (best is None or
+                                        len(changes) < len(best[1])):
+                best = res, changes
+                if not changes:
+                    break
+
+        if best is not None:
+            res, changes = best
+            if changes:
+                mask, value_list = _value_list(changes)
+                self.conn.core.ChangeGC(res.xid, mask, value_list)
+            res.values = values
+            return self._use(res)
+
+        gc = self.xids.generate_id()
+        mask, value_list = _value_list(values)
+        if depth == self.root_depth:
+            self.conn.core.CreateGC(gc, self.root, mask, value_list)
+        else:
+            # A GC can only be created from a drawable of its depth, but
+            # doesn't need that drawable afterwards.
+            pixmap = self.xids.generate_id()
+            self.conn.core.CreatePixmap(depth, pixmap, self.root, 1, 1)
+            self.conn.core.CreateGC(gc, pixmap, mask, value_list)
+            self.conn.core.FreePixmap(pixmap)
+            self.xids.free(pixmap)
+        self._busy[gc] = _Resource("gc", gc, ("gc", depth), values)
+        return gc
+
+    def _bytes(self, depth, width, height):
+        # good enough for a bound: bits per pixel is depth rounded up to a
+        # power of two
+        bits = 1
+        while bits < depth:
+            bits *= 2
+        return width * height * bits // 8
+
+    def _new_pixmap(self, depth, width, height):
+        pixmap = self.xids.generate_id()
+        self.conn.core.CreatePixmap(depth, pixmap, self.root, width, height)
+        return pixmap
+
+    def pixmap(self, depth, width, height):
+        """ Return a pixmap of `depth` which is at least `width` by `height`
+        pixels. """
+        w, h = _size_class(width), _size_class(height)
+        key = ("pixmap", depth, w, h)
+        idle = self._take(key)
+        if idle:
+            return self._use(idle[-1])
+        pixmap = self._new_pixmap(depth, w, h)
+        self._busy[pixmap] = _Resource("pixmap", pixmap, key, None, w, h,
+                                       self._bytes(depth, w, h))
+        return pixmap
+
+    def picture(self, format, depth, width, height, values=None):
+        """ Return a render picture with PICTFORMAT `format`, on a pixmap of
+        `depth` which is at least `width` by `height` pixels, whose
+        non-default attributes are `values` (render.CP bits to values). """
+        w, h = _size_class(width), _size_class(height)
+        key = ("picture", format, depth, w, h)
+        values = dict(values or {})
+        for res in reversed(self._take(key)):
+            changes = _changes(res.values, values, _PICTURE_DEFAULTS)
+            if changes is None:
+                continue
+            if changes:
+                mask, value_list = _value_list(changes)
+                self.render.ChangePicture(res.xid, mask, value_list)
+            res.values = values
+            return self._use(res)
+
+        pixmap = self._new_pixmap(depth, w, h)
+        picture = self.xids.generate_id()
+        mask, value_list = _value_list(values)
+        self.render.CreatePicture(picture, pixmap, format, mask, value_list)
+        self._busy[picture] = _Resource("picture", picture, key, values, w, h,
+                                        self._bytes(depth, w, h), pixmap)
+        return picture
+
+    def size(self, xid):
+        """ Return the real (width, height) of a pooled pixmap or picture. """
+        res = self._busy[xid]
+        return res.width, res.height
+
+    def pixmap_of(self, picture):
+        """ Return the pixmap a pooled picture is on. """
+        return self._busy[picture].pixmap
+
+    def release(self, *xids):
+        """ Hand resources back to the pool. Don't use them afterwards. """
+        now = time.time()
+        for xid in xids:
+            res = self._busy.pop(xid)
+            res.idle_since = now
+            self._idle[xid] = res
+            self._by_key.setdefault(res.key, []).append(res)
+            self.idle_bytes += res.nbytes
+        self.trim(now)
+
+    def trim(self, now=None):
+        """ Free idle resources beyond the pool's bounds. This happens on
+        every release; call it yourself to enforce `max_age` when nothing is
+        being released. """
+        if now is None:
+            now = time.time()
+        while self._idle:
+            res = next(iter(self._idle.values()))
+            if (len(self._idle) <= self.max_idle and
+                    self.idle_bytes <= self.max_idle_bytes and
+                    now - res.idle_since < self.max_age):
+                break
+            self._use(res)
+            self._free(res)
+
+    def _free(self, res):
+        del self._busy[res.xid]
+        if res.kind == "gc":
+            self.conn.core.FreeGC(res.xid)
+        elif res.kind == "pixmap":
+            self.conn.core.FreePixmap(res.xid)
+        else:
+            self.render.FreePicture(res.xid)
+            self.conn.core.FreePixmap(res.pixmap)
+            self.xids.free(res.pixmap)
+        self.xids.free(res.xid)
+
+    def close(self):
+        """ Free every idle resource. Ones that are still in use are left
+        alone. """
+        for res in list(self._idle.values()):
+            self._use(res)
+            self._free(res)
@@ -2,8 +2,12 @@
 # others who want to test things using xcffib.
 
 import os
+import six
 import time
 import errno
+import socket
+import struct
+import threading
 import subprocess
 
 from . import Connection, ConnectionException
@@ -83,3 +87,278 @@ class XvfbTest(object):
             if not os.path.exists(lock_path(self._display)):
                 return self._display
             self._display += 1
+
+
+class MockRequest(object):
+    """ A request received by a MockServer. `major` is the request's major
+    opcode, `minor` its second byte (the minor opcode, for extensions), and
+    `body` everything after the four byte request header. """
+
+    __slots__ = ('sequence', 'major', 'minor', 'body')
+
+    def __init__(self, sequence, major, minor, body):
+        self.sequence = sequence
+        self.major = major
+        self.minor = minor
+        self.body = body
+
+    def __repr__(self):
+        return "<MockRequest %d: %d/%d>" % (self.sequence, self.major,
+                                            self.minor)
+
+
+class MockError(object):
+    """ Return one of these from a MockServer handler to make the request
+    fail with error `code`. """
+
+    def __init__(self, code, bad_value=0):
+        self.code = code
+        self.bad_value = bad_value
+
+
+class MockServer(object):
+    """ A tiny in-process stand in for an X server, on the other end of a
+    socketpair. It does the connection setup (one 800x600 screen with a 24
+    bit TrueColor visual) and answers requests from a table of handlers,
+    which tests can fill in:
+
+        server = MockServer()
+        server.reply(16, struct.pack("=8xI", atom))  # InternAtom
+        conn = server.connect()
+
+    A handler is called with a MockRequest, and returns None for no reply, a
+    MockError, or the bytes of a reply. Replies are patched up with the right
+    response type, sequence number and length, so handlers only need to fill
+    in byte 1 and the bytes from 8 on. Requests without a handler get no
+    reply; GetInputFocus (which libxcb uses to sync) and QueryExtension (for
+    extensions added with add_extension) are answered by default.
+
+    Every response is delayed by `latency` seconds, as if it was that far
+    away; requests are still pipelined. Received requests are kept in
+    `requests` if `record` is set. The client's resource ids are
+    RESOURCE_ID_BASE plus the bits of `resource_id_mask`; a small mask makes
+    it run out of them quickly.
+    """
+
+    # The core opcodes the server knows about itself.
+    GET_INPUT_FOCUS = 43
+    QUERY_EXTENSION = 98
+
+    ROOT = 0x100
+    VISUAL = 0x21
+    COLORMAP = 0x20
+    RESOURCE_ID_BASE = 0x00200000
+
+    def __init__(self, latency=0, record=True, width=800, height=600,
+                 resource_id_mask=0x001fffff):
+        self.latency = latency
+        self.record = record
+        self.width = width
+        self.height = height
+        self.resource_id_mask = resource_id_mask
+        self.requests = []
+        self.sequence = 0
+        self.handlers = {}
+        self.extensions = {}
+        self.on(self.GET_INPUT_FOCUS, self._get_input_focus)
+        self.on(self.QUERY_EXTENSION, self._query_extension)
+
+        self._server, self._client = socket.socketpair()
+        self._order = "<"
+        self._pending = six.moves.queue.Queue()
+        self._reader = None
+        self._writer = None
+
+    def on(self, major, handler, minor=None):
+        """ Call `handler` for requests with opcode `major` (and, if given,
+        minor opcode `minor`). """
+        self.handlers[(major, minor)] = handler
+
+    def reply(self, major, data, minor=None):
+        """ Answer every `major` (`minor`) request with the reply `data`. """
+        self.on(major, lambda request: data, minor)
+
+    def error(self, major, code, minor=None, bad_value=0):
+        """ Fail every `major` (`minor`) request with error `code`. """
+        self.on(major, lambda request: MockError(code, bad_value), minor)
+
+    def add_extension(self, name, major_opcode, first_event=0,
+                      first_error=0):
+        """ Make QueryExtension report `name` as present. """
+        self.extensions[six.b(name)] = (major_opcode, first_event,
+                                        first_error)
+
+    def connect(self):
+        """ Start serving, and return a Connection to this server. """
+        self._reader = threading.Thread(target=self._read_loop)
+        self._writer = threading.Thread(target=self._write_loop)
+        self._reader.daemon = self._writer.daemon = True
+        self._reader.start()
+        self._writer.start()
+
+        # libxcb owns (and will close) the fd it is given.
+        fd = os.dup(self._client.fileno())
+        self._client.close()
+        return Connection(fd=fd)
+
+    def close(self):
+        """ Hang up on the client and stop the server's threads. """
+        try:
+            self._server.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self._pending.put(None)
+        for thread in (self._reader, self._writer):
+            if thread is not None:
+                thread.join()
+        self._server.close()
+
+    def send_event(self, data):
+        """ Send the 32 byte event `data` to the client. Its sequence number
+        is filled in with that of the last request received. """
+        data = bytearray(data)
+        assert len(data) == 32
+        # KeymapNotify is the one event without a sequence number.
+        if data[0] & 0x7f != 11:
+            struct.pack_into(self._order + "H", data, 2,
+                             self.sequence & 0xffff)
+        self._send(bytes(data), 0)
+
+    def _send(self, data, latency):
+        self._pending.put((time.time() + latency, data))
+
+    def _write_loop(self):
+        while True:
+            item = self._pending.get()
+            if item is None:
+                return
+            due, data = item
+            delay = due - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                self._server.sendall(data)
+            except socket.error:
+                return
+
+    def _recv(self, n):
+        buf = six.b("")
+        while len(buf) < n:
+            chunk = self._server.recv(n - len(buf))
+            if not chunk:
+                raise EOFError()
+            buf += chunk
+        return buf
+
+    def _read_loop(self):
+        try:
+            self._handshake()
+            while True:
+                self._request()
+        except (EOFError, socket.error):
+            pass
+
+    def _handshake(self):
+        header = self._recv(12)
+        self._order = "<" if header[0:1] == six.b("l") else ">"
+        _, _, name_len, data_len = struct.unpack(self._order + "HHHH",
+                                                 header[2:10])
+        self._recv((name_len + 3) & ~3)
+        self._recv((data_len + 3) & ~3)
+        self._send(self._setup(), 0)
+
+    def _setup(self):
+        o = self._order
+        vendor = six.b("xcffib mock server")
+        vendor_len = len(vendor)
+        vendor += six.b("\0") * (-vendor_len & 3)
+        formats = struct.pack(o + "BBB5x", 1, 1, 32) + \
+            struct.pack(o + "BBB5x", 24, 32, 32)
+        # visual_id, class (TrueColor), bits_per_rgb_value, colormap_entries,
+        # red, green and blue masks
+        visual = struct.pack(o + "IBBHIII4x", self.VISUAL, 4, 8, 256,
+                             0xff0000, 0xff00, 0xff)
+        depth = struct.pack(o + "BxH4x", 24, 1) + visual
+        screen = struct.pack(o + "IIIIIHHHHHHIBBBB",
+                             self.ROOT, self.COLORMAP, 0xffffff, 0, 0,
+                             self.width, self.height, 211, 158, 1, 1,
+                             self.VISUAL, 0, 0, 24, 1) + depth
+        # release, resource id base and mask, motion buffer size, vendor
+        # length, maximum request length, #screens, #formats, image byte
+        # order, bitmap bit order, scanline unit and pad, min and max keycode
+        info = struct.pack(o + "IIIIHHBBBBBBBB4x", 1, self.RESOURCE_ID_BASE,
+                           self.resource_id_mask, 256, vendor_len, 0xffff, 1,
+                           2, 0, 0, 32, 32, 8, 255)
+        data = info + vendor + formats + screen
+        return struct.pack(o + "BxHHH", 1, 11, 0, len(data) // 4) + data
+
+    def _request(self):
+        o = self._order
+        major, minor, length = struct.unpack(o + "BBH", self._recv(4))
+        if length == 0:
+            # BIG-REQUESTS
+            length, = struct.unpack(o + "I", self._recv(4))
+            body = self._recv(length * 4 - 8)
+        else:
+            body = self._recv(length * 4 - 4)
+        self.sequence += 1
+
+        request = MockRequest(self.sequence, major, minor, body)
+        if self.record:
+            self.requests.append(request)
+
+        handler = self.handlers.get((major, minor),
+                                    self.handlers.get((major, None)))
+        if handler is None:
+            return
+        response = handler(request)
+        if response is None:
+            return
+        seq = self.sequence & 0xffff
+        if isinstance(response, MockError):
+            packet = struct.pack(o + "BBHIHB21x", 0, response.code, seq,
+                                 response.bad_value, minor, major)
+        else:
+            packet = bytearray(response)
+            packet += six.b("\0") * max(32 - len(packet), -len(packet) & 3)
+            # (byte 1 is part of the reply)
+            packet[0] = 1
+            struct.pack_into(o + "HI", packet, 2, seq,
+                             (len(packet) - 32) // 4)
+            packet = bytes(packet)
+        self._send(packet, self.latency)
+
+    def _get_input_focus(self, request):
+        # revert_to = PointerRoot, focus = the root window
+        return struct.pack(self._order + "xBxxxxxxI", 1, self.ROOT)
+
+    def _query_extension(self, request):
+        name_len, = struct.unpack(self._order + "H", request.body[:2])
+        name = request.body[4:4 + name_len]
+        if name not in self.extensions:
+            return six.b("")
+        major, event, error = self.extensions[name]
+        return struct.pack(self._order + "8xBBBB", 1, major, event, error)
+
+
+class MockServerTest(object):
+    """ Like XvfbTest, but with a MockServer (as `self.server`) instead of an
+    Xvfb. Override `make_server` to configure the server before the
+    connection is made. """
+
+    def make_server(self):
+        return MockServer()
+
+    def setUp(self):
+        self.server = self.make_server()
+        self.conn = self.server.connect()
+
+    def tearDown(self):
+        try:
+            self.conn.disconnect()
+        except ConnectionException:
+            pass
+        finally:
+            self.conn = None
+        self.server.close()
+        self.server = None
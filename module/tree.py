@@ -0,0 +1,127 @@
+# A pipelined snapshot of the window hierarchy.
+
+from . import xproto
+from .properties import property_value
+
+
+class WindowRecord(object):
+    """ What `snapshot` found out about one window. `properties` maps each
+    requested property atom that is set on the window to a (type, format,
+    bytes) tuple. """
+
+    __slots__ = ('wid', 'parent', 'depth', 'x', 'y', 'width', 'height',
+                 'border_width', 'map_state', 'override_redirect', '_class',
+                 'properties', 'children')
+
+    def __init__(self, wid, parent):
+        self.wid = wid
+        self.parent = parent
+        self.properties = {}
+        self.children = []
+
+    def walk(self):
+        """ Yield this window and all its descendants, depth first. """
+        yield self
+        for child in self.children:
+            for w in child.walk():
+                yield w
+
+    def __repr__(self):
+        return "<WindowRecord 0x%x, %d children>" % (self.wid,
+                                                     len(self.children))
+
+
+def _reply(f):
+    """ Call f, returning None if the window it was about is gone. """
+    try:
+        return f()
+    except (xproto.WindowError, xproto.DrawableError):
+        return None
+
+
+def _discard(pending):
+    """ Throw away the replies nobody is going to read any more. """
+    for _, _, tree, geom, attrs, props in pending:
+        for cookie in [tree, geom, attrs] + [c for _, c in props]:
+            cookie.discard()
+
+
+def snapshot(conn, root=None, properties=(xproto.Atom.WM_NAME,),
+             property_length=256):
+    """ Build a tree of WindowRecords describing `root` (by default the
+    preferred screen's root window) and everything below it.
+
+    The tree is walked breadth first: for each level, the QueryTree,
+    GetGeometry, GetWindowAttributes and GetProperty requests for every window
+    on that level are all sent before any reply is read, so the whole
+    snapshot costs one round trip per level of the hierarchy rather than
+    several per window. At most `property_length` 32 bit units of each
+    property are read.
+
+    Windows which are destroyed while the snapshot is being taken are left
+    out of it. Any other error is raised, after the replies which were still
+    outstanding have been discarded.
+    """
+    core = conn.core
+    if root is None:
+        root = conn.setup.roots[conn.pref_screen].root
+
+    top = WindowRecord(root, xproto.Window._None)
+    level = [(top, None)]
+    while level:
+        pending = []
+        for record, parent in level:
+            w = record.wid
+            pending.append((
+                record,
+                parent,
+                core.QueryTree(w),
+                core.GetGeometry(w),
+                core.GetWindowAttributes(w),
+                [(atom, core.GetProperty(False, w, atom,
+                                         xproto.GetPropertyType.Any, 0,
+                                         property_length))
+                 for atom in properties],
+            ))
+
+        next_level = []
+        for record, parent, tree, geom, attrs, props in pending:
+            try:
+                tree = _reply(tree.reply)
+                geom = _reply(geom.reply)
+                attrs = _reply(attrs.reply)
+                values = [(atom, _reply(cookie.raw_reply))
+                          for atom, cookie in props]
+            except Exception:
+                # Anything else (e.g. a bad atom) is the caller's problem,
+                # but the rest of this level's replies would otherwise be
+                # left with libxcb until the connection is closed.
+                _discard(pending)
+                raise
+            if None in (tree, geom, attrs) or None in [v for _, v in values]:
+                # It went away after we asked about it.
+                if parent is not None:
+                    parent.children.remove(record)
+                continue
+
+            record.depth = geom.depth
+            record.x = geom.x
+            record.y = geom.y
+            record.width = geom.width
+            record.height = geom.height
+            record.border_width = geom.border_width
+            record.map_state = attrs.map_state
+            record.override_redirect = attrs.override_redirect
+            record._class = attrs._class
+            for atom, unpacker in values:
+                typ, fmt, _, data = property_value(unpacker)
+                if fmt != 0:
+                    record.properties[atom] = (typ, fmt, data.tobytes())
+
+            for child in tree.children:
+                child = WindowRecord(child, record.wid)
+                record.children.append(child)
+                next_level.append((child, record))
+        level = next_level
+
+    return top
@@ -26,7 +26,7 @@ class cffi_build(build):
 # version = subprocess.check_output(['git', 'describe', '--tags'])
 
 
-dependencies = ['six', 'cffi>=0.8.2']
+dependencies = ['six', 'cffi>=0.9']
 
 setup(
     name="xcffib",
@@ -26,15 +26,22 @@ tests = [ "event"
 mkFname :: String -> FilePath
 mkFname = (</>) $ "tests" </> "generator"
 
-mkTest :: String -> IO Test
-mkTest name = do
+-- | Test a backend; the expected output for the table backend lives in the
+-- tables subdirectory.
+mkTest :: Backend -> String -> IO Test
+mkTest backend name = do
   header <- fromFiles [mkFname $ name <.> ".xml"]
-  rawExpected <- readFile . mkFname $ name <.> ".py"
-  let [(fname, outPy)] = xform header
+  let expected = case backend of
+                   Classic -> mkFname $ name <.> ".py"
+                   Tables -> mkFname $ "tables" </> name <.> ".py"
+  rawExpected <- readFile expected
+  let [(fname, outPy)] = xformWith backend header
       rawOut = renderPy outPy
-  return $ testCase name $ do assertEqual "names equal" name fname
-                              -- TODO: we should really parse and compare ASTs
-                              assertEqual "rendering equal" rawExpected rawOut
+  return $ testCase (name ++ " " ++ show backend) $ do
+    assertEqual "names equal" name fname
+    -- TODO: we should really parse and compare ASTs
+    assertEqual "rendering equal" rawExpected rawOut
 
 main :: IO ()
-main = mapM mkTest tests >>= defaultMain
+main = mapM (uncurry mkTest) [ (b, t) | b <- [Classic, Tables], t <- tests ]
+         >>= defaultMain
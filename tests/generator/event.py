@@ -12,5 +12,8 @@ class ScreenChangeNotifyEvent(xcffib.Event):
         base = unpacker.offset
         self.rotation, self.timestamp, self.config_timestamp, self.root, self.request_window, self.sizeID, self.subpixel_order, self.width, self.height, self.mwidth, self.mheight = unpacker.unpack("xB2xIIIIHHHHHH")
         self.bufsize = unpacker.offset - base
+    _pack_struct = struct.Struct("=BB2xIIIIHHHHHH")
+    def pack(self):
+        return self._pack_struct.pack(self.response_type, self.rotation, self.timestamp, self.config_timestamp, self.root, self.request_window, self.sizeID, self.subpixel_order, self.width, self.height, self.mwidth, self.mheight)
 _events[0] = ScreenChangeNotifyEvent
 xcffib._add_ext(key, eventExtension, _events, _errors)
@@ -9,5 +9,8 @@ class KeymapNotifyEvent(xcffib.Event):
         base = unpacker.offset
         self.keys = xcffib.List(unpacker, "B", 31)
         self.bufsize = unpacker.offset - base
+    _pack_struct = struct.Struct("=B")
+    def pack(self):
+        return xcffib.pad_event(self._pack_struct.pack(self.response_type) + xcffib.pack_list(self.keys, "B"))
 _events[11] = KeymapNotifyEvent
 xcffib._add_ext(key, no_sequenceExtension, _events, _errors)
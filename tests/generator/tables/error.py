@@ -0,0 +1,13 @@
+import xcffib
+import struct
+import six
+MAJOR_VERSION = 2
+MINOR_VERSION = 2
+key = xcffib.ExtensionKey("ERROR")
+_events = {}
+_errors = {}
+class RequestError(xcffib.Error):
+    _fields = ["xx2xIHBx", ["bad_value", "minor_opcode", "major_opcode"], []]
+BadRequest = RequestError
+_errors[1] = RequestError
+xcffib._add_ext(key, errorExtension, _events, _errors)
@@ -0,0 +1,12 @@
+import xcffib
+import struct
+import six
+MAJOR_VERSION = 1
+MINOR_VERSION = 4
+key = xcffib.ExtensionKey("EVENT")
+_events = {}
+_errors = {}
+class ScreenChangeNotifyEvent(xcffib.Event):
+    _fields = ["xB2xIIIIHHHHHH", ["rotation", "timestamp", "config_timestamp", "root", "request_window", "sizeID", "subpixel_order", "width", "height", "mwidth", "mheight"], []]
+_events[0] = ScreenChangeNotifyEvent
+xcffib._add_ext(key, eventExtension, _events, _errors)
@@ -0,0 +1,9 @@
+import xcffib
+import struct
+import six
+_events = {}
+_errors = {}
+class KeymapNotifyEvent(xcffib.Event):
+    _fields = ["x", [], [["keys", "B", lambda s: 31]]]
+_events[11] = KeymapNotifyEvent
+xcffib._add_ext(key, no_sequenceExtension, _events, _errors)
@@ -0,0 +1,8 @@
+import xcffib
+import struct
+import six
+_events = {}
+_errors = {}
+class requestExtension(xcffib.Extension):
+    CreateWindow = xcffib.request_method(1, ["depth", "wid", "parent", "x", "y", "width", "height", "border_width", "_class", "visual", "value_mask", "value_list"], "xB2xIIhhHHHHI", ["depth", "wid", "parent", "x", "y", "width", "height", "border_width", "_class", "visual"], [["valueparam", "I", "value_mask", "value_list"]], None, False)
+xcffib._add_ext(key, requestExtension, _events, _errors)
@@ -0,0 +1,14 @@
+import xcffib
+import struct
+import six
+_events = {}
+_errors = {}
+class STR(xcffib.Struct):
+    _fields = ["B", ["name_len"], [["name", "c", lambda s: s.name_len]]]
+class ListExtensionsReply(xcffib.Reply):
+    _fields = ["xB2x4x24x", ["names_len"], [["names", STR, lambda s: s.names_len]]]
+class ListExtensionsCookie(xcffib.Cookie):
+    reply_type = ListExtensionsReply
+class request_replyExtension(xcffib.Extension):
+    ListExtensions = xcffib.request_method(99, [], "xx2x", [], [], ListExtensionsCookie, True)
+xcffib._add_ext(key, request_replyExtension, _events, _errors)
@@ -0,0 +1,10 @@
+import xcffib
+import struct
+import six
+_events = {}
+_errors = {}
+class AxisInfo(xcffib.Struct):
+    _fields = ["Iii", ["resolution", "minimum", "maximum"], []]
+class ValuatorInfo(xcffib.Struct):
+    _fields = ["BBBBI", ["class_id", "len", "axes_len", "mode", "motion_size"], [["axes", AxisInfo, lambda s: s.axes_len]]]
+xcffib._add_ext(key, structExtension, _events, _errors)
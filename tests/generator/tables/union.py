@@ -0,0 +1,8 @@
+import xcffib
+import struct
+import six
+_events = {}
+_errors = {}
+class ClientMessageData(xcffib.Union):
+    _fields = ["", [], [["data8", "B", lambda s: 20], ["data16", "H", lambda s: 10], ["data32", "I", lambda s: 5]]]
+xcffib._add_ext(key, unionExtension, _events, _errors)
@@ -6,7 +6,12 @@ _errors = {}
 class ClientMessageData(xcffib.Union):
     def __init__(self, unpacker):
         xcffib.Union.__init__(self, unpacker)
+        base = unpacker.offset
         self.data8 = xcffib.List(unpacker, "B", 20)
+        unpacker.offset = base
         self.data16 = xcffib.List(unpacker, "H", 10)
+        unpacker.offset = base
         self.data32 = xcffib.List(unpacker, "I", 5)
+    def pack(self):
+        return xcffib.pack_union(self, [["data8", "B", None], ["data16", "H", None], ["data32", "I", None]])
 xcffib._add_ext(key, unionExtension, _events, _errors)
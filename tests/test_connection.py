@@ -3,12 +3,29 @@ import six
 import xcffib
 from xcffib.ffi import ffi, C
 import xcffib.xproto
+import xcffib.image
+import xcffib.properties
+import xcffib.coalesce
+import xcffib.replay
+import xcffib.tree
+import xcffib.keymap
+import xcffib.resources
+import xcffib.capture
+import xcffib.pool
+import xcffib.glyphs
+import xcffib.render
+import xcffib.damage
+import xcffib.present
 from xcffib.xproto import EventMask
-from xcffib.testing import XvfbTest
+from xcffib.testing import XvfbTest, MockServer, MockServerTest
 
 from nose.tools import raises
 
+import signal
+import struct
 import subprocess
+import tempfile
+import time
 
 
 class TestConnection(XvfbTest):
@@ -142,7 +159,836 @@ class TestConnection(XvfbTest):
         e = self.conn.wait_for_event()
         assert isinstance(e, xcffib.xproto.CreateNotifyEvent)
 
+    def test_send_client_message(self):
+        wid = self.conn.generate_id()
+        self.create_window(wid=wid)
+        atom = self.xproto.InternAtom(False, 4, six.b("TEST")).reply().atom
+        data = xcffib.xproto.ClientMessageData.synthetic(data32=[1, 2, 3, 4, 5])
+        event = xcffib.xproto.ClientMessageEvent.synthetic(
+            format=32, window=wid, type=atom, data=data)
+        packed = event.pack()
+        assert len(packed) == 32
+        self.xproto.SendEvent(False, wid, EventMask.StructureNotify, packed)
+        self.conn.flush()
+
+        e = self.conn.wait_for_event()
+        while not isinstance(e, xcffib.xproto.ClientMessageEvent):
+            e = self.conn.wait_for_event()
+        assert e.window == wid
+        assert e.type == atom
+        assert list(e.data.data32) == [1, 2, 3, 4, 5]
+        # The server only adds the "sent" bit and the sequence number.
+        assert e.pack()[0:1] == six.b(chr(33 | 0x80))
+        assert e.pack()[4:] == packed[4:]
+
     @raises(xcffib.xproto.WindowError)
     def test_query_invalid_wid_generates_error(self):
         # query a bad WINDOW
         self.xproto.QueryTree(0xf00).reply()
+
+    def test_put_get_image_array(self):
+        numpy = import_numpy()
+        screen = self.default_screen
+        depth = screen.root_depth
+        width, height = 4, 2
+
+        pid = self.conn.generate_id()
+        self.xproto.CreatePixmap(depth, pid, screen.root, width, height)
+        gc = self.conn.generate_id()
+        self.xproto.CreateGC(gc, pid, 0, [])
+
+        stride = xcffib.image.image_stride(self.conn.setup, depth, width)
+        data = numpy.arange(stride * height, dtype=numpy.uint8)
+        self.xproto.PutImage(xcffib.xproto.ImageFormat.ZPixmap, pid, gc,
+                             width, height, 0, 0, 0, depth, data)
+
+        arr = xcffib.image.get_image_array(self.conn, pid, 0, 0, width, height)
+        assert arr.shape == (height, width)
+        assert arr.tobytes() == data.tobytes()
+
+    def _shared_image_roundtrip(self, use_shm):
+        screen = self.default_screen
+        depth = screen.root_depth
+        pid = self.conn.generate_id()
+        self.xproto.CreatePixmap(depth, pid, screen.root, 8, 8)
+        gc = self.conn.generate_id()
+        self.xproto.CreateGC(gc, pid, 0, [])
+
+        src = xcffib.image.SharedImage(self.conn, 8, 8, depth, use_shm)
+        assert src.shm == use_shm
+        for i in range(src.size):
+            src.buf[i:i + 1] = six.int2byte(i & 0xff)
+        src.put_image_shm(pid, gc)
+
+        dst = xcffib.image.SharedImage(self.conn, 8, 8, depth, use_shm)
+        assert dst.get_image_shm(pid).tobytes() == src.buf.tobytes()
+        src.close()
+        dst.close()
+
+    def test_shared_image_shm(self):
+        self._shared_image_roundtrip(True)
+
+    def test_shared_image_socket(self):
+        self._shared_image_roundtrip(False)
+
+    @raises(xcffib.XcffibException)
+    def test_shared_image_closed(self):
+        image = xcffib.image.SharedImage(self.conn, 8, 8,
+                                         self.default_screen.root_depth)
+        image.close()
+        image.get_image_shm(self.default_screen.root)
+
+    def test_iter_property(self):
+        wid = self.conn.generate_id()
+        self.create_window(wid)
+        value = six.b("0123456789abcdef") * 4096
+        self.xproto.ChangeProperty(xcffib.xproto.PropMode.Replace, wid,
+                                   xcffib.xproto.Atom.WM_NAME,
+                                   xcffib.xproto.Atom.STRING, 8, len(value),
+                                   value)
+
+        chunks = list(xcffib.properties.iter_property(
+            self.conn, wid, xcffib.xproto.Atom.WM_NAME, chunk_size=1000))
+        assert len(chunks) > 1
+        assert all(fmt == 8 for _, fmt, _ in chunks)
+        assert six.b("").join(c.tobytes() for _, _, c in chunks) == value
+
+        # the wrong type: one request, and no chunks
+        sequence = self.conn.core.GetInputFocus().sequence
+        chunks = list(xcffib.properties.iter_property(
+            self.conn, wid, xcffib.xproto.Atom.WM_NAME,
+            xcffib.xproto.Atom.ATOM, chunk_size=1000))
+        assert chunks == []
+        assert self.conn.core.GetInputFocus().sequence == sequence + 2
+
+    def test_coalesce_configure_notify(self):
+        wid = self.conn.generate_id()
+        self.create_window(wid)
+        for x in range(1, 6):
+            self.xproto.ConfigureWindow(wid, xcffib.xproto.ConfigWindow.X, [x])
+        # make sure all the events have arrived
+        self.xproto.GetInputFocus().reply()
+
+        coalescer = xcffib.coalesce.EventCoalescer(self.conn)
+        e = coalescer.wait_for_event()
+        assert isinstance(e, xcffib.xproto.ConfigureNotifyEvent)
+        assert e.x == 5
+        assert coalescer.poll_for_event() is None
+
+        # each coalescer has its own types
+        coalescer.types[xcffib.coalesce.EXPOSE] = 4
+        assert xcffib.coalesce.EXPOSE not in \
+            xcffib.coalesce.EventCoalescer(self.conn).types
+
+    def test_record_and_replay(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            self.conn.recorder = xcffib.replay.Recorder(path)
+            wid = self.conn.generate_id()
+            self.create_window(wid, w=7, h=9)
+            geom = self.xproto.GetGeometry(wid).reply()
+            # replies that are never decoded are recorded too
+            self.xproto.GetGeometry(wid).raw_reply()
+            self.xproto.ConfigureWindow(wid, xcffib.xproto.ConfigWindow.X, [3])
+            self.conn.flush()
+            event = self.conn.wait_for_event()
+            self.conn.recorder.close()
+            self.conn.recorder = None
+
+            replayer = xcffib.replay.Replayer(path)
+            replayed = list(replayer)
+            assert len(replayed) == 3
+            for reply in replayed[:2]:
+                assert isinstance(reply, xcffib.xproto.GetGeometryReply)
+                assert (reply.width, reply.height) == (geom.width, geom.height)
+            assert isinstance(replayed[2], type(event))
+            assert replayed[2].x == event.x == 3
+            replayer.close()
+
+            # each class name is only written once
+            with open(path, 'rb') as f:
+                assert f.read().count(six.b("GetGeometryReply")) == 1
+        finally:
+            os.remove(path)
+
+    def test_tree_snapshot(self):
+        parent = self.conn.generate_id()
+        self.create_window(parent, w=10, h=10)
+        child = self.conn.generate_id()
+        self.xproto.CreateWindow(
+            self.default_screen.root_depth, child, parent, 1, 2, 3, 4, 0,
+            xcffib.xproto.WindowClass.InputOutput,
+            self.default_screen.root_visual, 0, [])
+        name = six.b("child")
+        self.xproto.ChangeProperty(xcffib.xproto.PropMode.Replace, child,
+                                   xcffib.xproto.Atom.WM_NAME,
+                                   xcffib.xproto.Atom.STRING, 8, len(name),
+                                   name)
+
+        top = xcffib.tree.snapshot(self.conn)
+        assert top.wid == self.default_screen.root
+        assert [w.wid for w in top.walk()] == [top.wid, parent, child]
+        record = top.children[0].children[0]
+        assert (record.x, record.y, record.width, record.height) == (1, 2, 3, 4)
+        assert record.properties[xcffib.xproto.Atom.WM_NAME][2] == name
+
+    def test_tree_snapshot_error(self):
+        wid = self.conn.generate_id()
+        self.create_window(wid)
+        try:
+            xcffib.tree.snapshot(self.conn, properties=[0xffffff])
+        except xcffib.xproto.AtomError:
+            pass
+        else:
+            raise AssertionError("AtomError not raised")
+        assert self.conn.outstanding_replies == 0
+
+    def test_property_cache(self):
+        wid = self.conn.generate_id()
+        self.create_window(wid)
+        atom = xcffib.xproto.Atom.WM_NAME
+        cache = xcffib.properties.PropertyCache(self.conn)
+        assert cache.get(wid, atom) is None
+
+        def set_name(name):
+            self.xproto.ChangeProperty(xcffib.xproto.PropMode.Replace, wid,
+                                       atom, xcffib.xproto.Atom.STRING, 8,
+                                       len(name), name)
+            self.conn.flush()
+            while not isinstance(self.conn.wait_for_event(),
+                                 xcffib.xproto.PropertyNotifyEvent):
+                pass
+
+        set_name(six.b("foo"))
+        assert cache.get(wid, atom)[2] == six.b("foo")
+        assert (wid, atom) in cache._entries
+
+        set_name(six.b("bar"))
+        assert (wid, atom) not in cache._entries
+        assert wid not in cache._windows
+        assert cache.get(wid, atom)[2] == six.b("bar")
+
+        # evicting a window's last property forgets the window
+        cache.max_entries = 1
+        cache.get(self.default_screen.root, atom)
+        assert list(cache._windows) == [self.default_screen.root]
+        cache.close()
+
+    def test_keymap(self):
+        keymap = xcffib.keymap.Keymap(self.conn)
+        keycode = keymap.max_keycode
+        keysyms = [0x1234] * keymap.keysyms_per_keycode
+        self.xproto.ChangeKeyboardMapping(1, keycode,
+                                          keymap.keysyms_per_keycode, keysyms)
+        self.conn.flush()
+        while not isinstance(self.conn.wait_for_event(),
+                             xcffib.xproto.MappingNotifyEvent):
+            pass
+
+        assert keymap.keysym(keycode) == 0x1234
+        assert keymap.keycodes(0x1234) == [keycode]
+        keymap.close()
+
+    def test_lazy_list(self):
+        eager = self.conn.core.ListExtensions().reply().names
+        lazy = self.conn.core.ListExtensions().reply(lazy=True).names
+
+        assert len(lazy) == len(eager)
+        assert lazy._items[-1] is xcffib._unloaded
+        assert lazy[-1].name.to_string() == eager[-1].name.to_string()
+        assert [n.name.to_string() for n in lazy] == \
+            [n.name.to_string() for n in eager]
+        # .list is always the decoded elements
+        assert [n.name.to_string() for n in lazy.list] == \
+            [n.name.to_string() for n in eager]
+
+        # other replies aren't affected
+        assert self.conn.core.ListExtensions().reply().names._offsets is None
+
+    def test_discard_reply(self):
+        assert self.conn.outstanding_replies == 0
+        cookie = self.xproto.GetInputFocus()
+        assert self.conn.outstanding_replies == 1
+        cookie.discard()
+        assert self.conn.outstanding_replies == 0
+        # The connection is still fine afterwards.
+        self.xproto.GetInputFocus().reply()
+        assert self.conn.outstanding_replies == 0
+
+    def test_auto_discard(self):
+        self.conn.auto_discard = True
+        self.xproto.GetInputFocus()
+        self.create_window(is_checked=True)
+        assert self.conn.outstanding_replies == 0
+
+        self.conn.auto_discard = False
+        self.xproto.GetInputFocus()
+        assert self.conn.outstanding_replies == 1
+
+    def test_prefetch_extensions(self):
+        import xcffib.shm
+        import xcffib.xfixes
+        conn = xcffib.Connection(os.environ['DISPLAY'],
+                                 extensions=[xcffib.shm.key, xcffib.xfixes.key])
+        try:
+            shm = conn(xcffib.shm.key)
+            assert shm.present
+            assert shm.major_opcode > 127
+            assert conn(xcffib.xfixes.key).present
+        finally:
+            conn.disconnect()
+
+    def test_xid_allocator(self):
+        allocator = xcffib.resources.XidAllocator(self.conn)
+        ids = allocator.generate_ids(100)
+        assert len(set(ids)) == 100
+        mask = self.conn.setup.resource_id_mask
+        assert all(i & ~mask == self.conn.setup.resource_id_base for i in ids)
+
+        allocator.free(ids[0], ids[1])
+        assert set(allocator.generate_ids(3)[:2]) == set(ids[:2])
+
+    def test_resource_pool(self):
+        GC = xcffib.xproto.GC
+        pool = xcffib.resources.ResourcePool(self.conn, max_idle=2)
+        gc = pool.gc(values={GC.Foreground: 1, GC.LineWidth: 3})
+        pixmap = pool.pixmap(self.default_screen.root_depth, 20, 10)
+        assert pool.size(pixmap) == (32, 16)
+        pool.release(gc, pixmap)
+
+        # the same resources come back; LineWidth is reset to its default
+        assert pool.gc(values={GC.Foreground: 2}) == gc
+        attrs = self.xproto.GetGeometry(pool.pixmap(
+            self.default_screen.root_depth, 30, 16)).reply()
+        assert (attrs.width, attrs.height) == (32, 16)
+        self.xproto.CopyArea(pixmap, pixmap, gc, 0, 0, 1, 1, 2, 2,
+                             is_checked=True).check()
+
+        # and are freed once idle for too long
+        pool.release(gc, pixmap)
+        pool.trim(time.time() + pool.max_age)
+        assert pool.idle_bytes == 0
+        pool.close()
+
+    def test_check_all(self):
+        wid = self.conn.generate_id()
+        good = self.create_window(wid, is_checked=True)
+        bad = self.xproto.MapWindow(0xf00, is_checked=True)
+        also_good = self.xproto.MapWindow(wid, is_checked=True)
+
+        assert self.conn.check_all([good, also_good]) == []
+
+        bad2 = self.xproto.MapWindow(0xf01, is_checked=True)
+        failures = self.conn.check_all([bad, bad2], raise_errors=False)
+        assert [c for c, _ in failures] == [bad, bad2]
+        assert all(isinstance(e, xcffib.xproto.WindowError)
+                   for _, e in failures)
+
+    @raises(xcffib.RequestErrors)
+    def test_check_all_raises(self):
+        self.conn.check_all([self.xproto.MapWindow(0xf00, is_checked=True)])
+
+    def test_damage_capture(self):
+        root = self.default_screen.root
+        capture = xcffib.capture.DamageCapture(self.conn, root)
+        assert capture.update() == []
+
+        # two separate rectangles, fetched with pipelined GetImages
+        for x in (10, 40):
+            wid = self.conn.generate_id()
+            self.create_window(wid, x=x, y=10, w=5, h=5)
+            self.xproto.MapWindow(wid)
+        self.conn.flush()
+        while not capture.dirty:
+            self.conn.wait_for_event()
+        self.xproto.GetInputFocus().reply()
+        while self.conn.poll_for_event():
+            pass
+
+        assert len(capture.update()) >= 2
+        full = xcffib.image.SharedImage(self.conn, capture.width,
+                                        capture.height, capture.depth, False)
+        assert capture.frame.buf.tobytes() == full.get_image_shm(root).tobytes()
+        capture.close()
+
+    @raises(xcffib.TimeoutException)
+    def test_wait_for_event_timeout(self):
+        self.conn.wait_for_event(timeout=0.1)
+
+    def test_reply_timeout(self):
+        self._xvfb.send_signal(signal.SIGSTOP)
+        try:
+            cookie = self.xproto.GetInputFocus()
+            try:
+                cookie.reply(timeout=0.2)
+                assert False, "reply didn't time out"
+            except xcffib.TimeoutException:
+                pass
+        finally:
+            self._xvfb.send_signal(signal.SIGCONT)
+
+        # the reply is still there, and the connection is fine
+        cookie.reply(timeout=5)
+        self.create_window(is_checked=True).check(timeout=5)
+
+    def test_worker_pool(self):
+        root = self.default_screen.root
+        wid = self.conn.generate_id()
+        self.create_window(wid)
+        value = six.b("x") * 10000
+        self.xproto.ChangeProperty(xcffib.xproto.PropMode.Replace, wid,
+                                   xcffib.xproto.Atom.WM_NAME,
+                                   xcffib.xproto.Atom.STRING, 8, len(value),
+                                   value)
+        self.conn.flush()
+        expected = xcffib.image.SharedImage(self.conn, 100, 100,
+                                            self.default_screen.root_depth,
+                                            False).get_image_shm(root)
+
+        with xcffib.pool.WorkerPool(self.conn, 2, threshold=1000) as pool:
+            image = pool.get_image(root, 0, 0, 100, 100)
+            prop = pool.get_property(wid, xcffib.xproto.Atom.WM_NAME)
+            tree = pool.snapshot()
+            setup = pool.submit(_vendor)
+
+            image = image.get()
+            assert isinstance(image.data, xcffib.pool.SharedBuffer)
+            assert image.data.tobytes()[:len(expected)] == expected.tobytes()
+            image.close()
+
+            typ, fmt, data = prop.get()
+            assert (typ, fmt) == (xcffib.xproto.Atom.STRING, 8)
+            assert data.tobytes() == value
+
+            assert wid in [w.wid for w in tree.get().walk()]
+            assert setup.get() == self.conn.setup.vendor.to_string()
+
+    def test_pool_uncollected(self):
+        root = self.default_screen.root
+        gone = ffi.cast("void *", -1)
+        pool = xcffib.pool.WorkerPool(self.conn, 1, threshold=1000)
+        try:
+            dropped = pool.get_image(root, 0, 0, 100, 100)
+            kept = pool.get_image(root, 0, 0, 100, 100)
+            dropped._result.wait()
+            kept._result.wait()
+            segment, = xcffib.pool._segments(dropped._result.get())
+            del dropped
+            assert C.shmat(segment.shmid, ffi.NULL, 0) == gone
+            assert len(pool._segments) == 1
+        finally:
+            pool.close()
+        # never collected, so freed by close()
+        segment, = xcffib.pool._segments(kept._result.get())
+        assert C.shmat(segment.shmid, ffi.NULL, 0) == gone
+        assert not pool._segments
+
+    def test_glyph_cache(self):
+        loaded = []
+
+        def loader(key):
+            loaded.append(key)
+            # a solid 4x4 glyph, 5 pixels wide
+            return 4, 4, 0, 0, 5, 0, six.b("\xff") * 16
+
+        cache = xcffib.glyphs.GlyphCache(self.conn, max_glyphs=2)
+        font = cache.font(("test", 4), loader)
+
+        pid = self.conn.generate_id()
+        self.xproto.CreatePixmap(8, pid, self.default_screen.root, 20, 4)
+        picture = self.conn.generate_id()
+        cache.render.CreatePicture(picture, pid, cache.format, 0, [])
+
+        cache.draw_text(picture, font, "ab", 0, 0)
+        cache.draw_text(picture, font, "ab", 0, 0)
+        assert loaded == ["a", "b"]
+
+        # "c" evicts "a", the least recently used
+        cache.draw_text(picture, font, "bc", 10, 0)
+        assert loaded == ["a", "b", "c"]
+        assert set(font.glyphs) == set("bc")
+
+        image = self.xproto.GetImage(xcffib.xproto.ImageFormat.ZPixmap, pid,
+                                     0, 0, 20, 1, 0xffffffff).reply()
+        row = bytearray(image.data.raw)
+        assert row[0] == row[5] == row[10] == row[15] == 0xff
+        assert row[4] == 0
+
+        # redrawing "bc" from the run cache counts as using both, in order,
+        # so "d" evicts "b" even though "c" was looked up less recently
+        cache.draw_text(picture, font, "b", 0, 0)
+        cache.draw_text(picture, font, "bc", 0, 0)
+        cache.draw_text(picture, font, "d", 0, 0)
+        assert set(font.glyphs) == set("cd")
+        cache.close()
+
+    def test_glyph_cache_runs(self):
+        def loader(key):
+            return 4, 4, 0, 0, 5, 0, six.b("\xff") * 16
+
+        cache = xcffib.glyphs.GlyphCache(self.conn, max_glyphs=3)
+        font = cache.font(("test", 4), loader)
+        pid = self.conn.generate_id()
+        self.xproto.CreatePixmap(8, pid, self.default_screen.root, 40, 4)
+        picture = self.conn.generate_id()
+        cache.render.CreatePicture(picture, pid, cache.format, 0, [])
+
+        # "xyz" doesn't fit alongside "abc", but mustn't evict it before
+        # the request drawing both is sent
+        cache.composite(xcffib.render.PictOp.Over, cache.solid((0, 0, 0, 1)),
+                        picture, [(font, "abc", 0, 0), (font, "xyz", 20, 0)])
+        assert set(font.glyphs) == set("abcxyz")
+        ids = [font.glyphs[key][0] for key in "abcxyz"]
+        assert len(set(ids)) == 6
+        cache.close()
+
+
+def test_pack_glyph_elts():
+    elts = xcffib.glyphs.pack_glyph_elts([(None, 3, 4, [1, 2, 3])], 1)
+    assert elts == struct.pack("=B3xhhBBBx", 3, 3, 4, 1, 2, 3)
+
+    elts = xcffib.glyphs.pack_glyph_elts([(None, 0, 0, [1]),
+                                          (7, 1, 0, [300] * 300)], 2)
+    assert len(elts) == 8 + 4 + 12 + (8 + 254 * 2) + (8 + 46 * 2)
+    assert elts[12:24] == struct.pack("=B3xhhI", 255, 0, 0, 7)
+
+
+def _vendor(conn):
+    return conn.setup.vendor.to_string()
+
+
+class TestMockServer(MockServerTest):
+
+    def make_server(self):
+        server = MockServer()
+        server.reply(16, struct.pack("=8xI", 0x1234))  # InternAtom
+        server.error(8, 3)  # MapWindow, BadWindow
+        server.add_extension("DAMAGE", 140, first_event=90)
+        return server
+
+    def test_setup(self):
+        screen = self.conn.setup.roots[0]
+        assert screen.root == MockServer.ROOT
+        assert screen.width_in_pixels == 800
+
+    def test_canned_reply(self):
+        reply = self.conn.core.InternAtom(False, 4, six.b("ATOM")).reply()
+        assert reply.atom == 0x1234
+        request = self.server.requests[-1]
+        assert request.major == 16
+        assert request.body[4:8] == six.b("ATOM")
+
+    @raises(xcffib.xproto.WindowError)
+    def test_error(self):
+        self.conn.core.MapWindowChecked(MockServer.ROOT).check()
+
+    def test_send_event(self):
+        event = struct.pack("=BxxxIHHHHH14x", 12, MockServer.ROOT,
+                            0, 0, 10, 10, 0)
+        self.server.send_event(event)
+        e = self.conn.wait_for_event(timeout=5)
+        assert isinstance(e, xcffib.xproto.ExposeEvent)
+        assert e.window == MockServer.ROOT
+
+    def test_record_extension_event(self):
+        assert self.conn(xcffib.damage.key).present
+        rect = xcffib.xproto.RECTANGLE.synthetic(x=1, y=2, width=3, height=4)
+        event = xcffib.damage.NotifyEvent.synthetic(
+            response_type=90, level=0, drawable=MockServer.ROOT, damage=5,
+            timestamp=0, area=rect, geometry=rect)
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            self.conn.recorder = xcffib.replay.Recorder(path)
+            self.server.send_event(event.pack())
+            e = self.conn.wait_for_event(timeout=5)
+            self.conn.recorder.close()
+            self.conn.recorder = None
+            assert isinstance(e, xcffib.damage.NotifyEvent)
+
+            # the replayer doesn't know DAMAGE's first_event, but the
+            # recording says which class it was
+            replayer = xcffib.replay.Replayer(path)
+            replayed, = list(replayer)
+            assert isinstance(replayed, xcffib.damage.NotifyEvent)
+            assert replayed.damage == 5
+            assert replayed.area.height == 4
+            replayer.close()
+        finally:
+            os.remove(path)
+
+    def test_coalesce_expose(self):
+        for x, y, count in [(0, 0, 2), (10, 5, 1), (20, 20, 0)]:
+            event = xcffib.xproto.ExposeEvent.synthetic(
+                window=MockServer.ROOT, x=x, y=y, width=5, height=5,
+                count=count)
+            self.server.send_event(event.pack())
+        # the events are sent before the reply
+        self.conn.core.GetInputFocus().reply()
+
+        coalescer = xcffib.coalesce.EventCoalescer(self.conn)
+        e = coalescer.wait_for_event()
+        assert isinstance(e, xcffib.xproto.ExposeEvent)
+        assert (e.x, e.y, e.width, e.height, e.count) == (0, 0, 25, 25, 0)
+        assert e.rects == [(0, 0, 5, 5), (10, 5, 5, 5), (20, 20, 5, 5)]
+        assert coalescer.poll_for_event() is None
+
+    def test_latency(self):
+        self.server.latency = 0.2
+        cookies = [self.conn.core.GetInputFocus() for _ in range(10)]
+        start = time.time()
+        for cookie in cookies:
+            assert cookie.reply().focus == MockServer.ROOT
+        # The requests are pipelined, so this is one delay, not ten.
+        assert 0.2 <= time.time() - start < 1.5
+
+    @raises(xcffib.TimeoutException)
+    def test_no_handler(self):
+        # GetGeometry isn't answered by default
+        self.conn.core.GetGeometry(MockServer.ROOT).reply(timeout=0.1)
+
+
+class TestExtensionEvents(MockServerTest):
+
+    def make_server(self):
+        server = MockServer()
+        server.add_extension("DAMAGE", 140, first_event=90)
+        return server
+
+    def wait_for(self, data):
+        self.server.send_event(data)
+        return self.conn.wait_for_event(timeout=5)
+
+    def test_no_first_event(self):
+        # Present only has GenericEvents, so it doesn't get a first_event.
+        self.server.add_extension("Present", 141)
+        assert self.conn(xcffib.present.key).present
+        e = self.wait_for(struct.pack("=BBxxIIIIhhhhHBx", 2, 38, 0,
+                                      MockServer.ROOT, MockServer.ROOT, 0,
+                                      1, 2, 1, 2, 0, 1))
+        assert isinstance(e, xcffib.xproto.KeyPressEvent)
+        assert e.detail == 38
+
+    def test_core_numbers(self):
+        self.server.add_extension("Present", 141, first_event=32)
+        self.conn(xcffib.present.key)
+        e = self.wait_for(struct.pack("=BxHBBB25x", 34, 0, 0, 8, 248))
+        assert isinstance(e, xcffib.xproto.MappingNotifyEvent)
+
+    def test_overlapping_numbers(self):
+        # Present's numbers run into DAMAGE's range, which wins whichever
+        # extension is set up first.
+        self.server.add_extension("Present", 141, first_event=88)
+        self.conn(xcffib.damage.key)
+        self.conn(xcffib.present.key)
+        rect = xcffib.xproto.RECTANGLE.synthetic(x=0, y=0, width=1, height=1)
+        event = xcffib.damage.NotifyEvent.synthetic(
+            response_type=90, level=0, drawable=MockServer.ROOT, damage=5,
+            timestamp=0, area=rect, geometry=rect)
+        e = self.wait_for(event.pack())
+        assert isinstance(e, xcffib.damage.NotifyEvent)
+        assert e.damage == 5
+
+
+class TestXidExhaustion(MockServerTest):
+
+    XC_MISC = 130
+    BASE = MockServer.RESOURCE_ID_BASE
+
+    def make_server(self):
+        # 16 ids, which libxcb hands out before asking XC-MISC for more
+        server = MockServer(resource_id_mask=0xf)
+        server.add_extension("XC-MISC", self.XC_MISC)
+        # libxcb's GetXIDRange gets "none left", the allocator's gets two ids
+        # (one of which it already has in its free list)
+        self.ranges = [(0, 1), (self.BASE | 4, 2)]
+        server.on(self.XC_MISC, self._get_xid_range, minor=1)
+        server.on(self.XC_MISC, self._get_xid_list, minor=2)
+        return server
+
+    def _get_xid_range(self, request):
+        start, count = self.ranges.pop(0) if self.ranges else (0, 1)
+        return struct.pack("=8xII", start, count)
+
+    def _get_xid_list(self, request):
+        ids = [self.BASE | 4, self.BASE | 9]
+        return struct.pack("=8xI20x%dI" % len(ids), len(ids), *ids)
+
+    def _xid_requests(self, minor):
+        return len([r for r in self.server.requests
+                    if r.major == self.XC_MISC and r.minor == minor])
+
+    def test_recovers(self):
+        # libxcb's ids are used up by someone else
+        ids = self.conn.generate_ids(16)
+        assert sorted(ids) == [self.BASE | i for i in range(16)]
+
+        allocator = xcffib.resources.XidAllocator(self.conn)
+        allocator.free(self.BASE | 4)
+        ids = allocator.generate_ids(3)
+        # 4 is only handed out once, even though both XC-MISC requests
+        # report it as unused
+        assert ids == [self.BASE | 4, self.BASE | 5, self.BASE | 9]
+        assert self._xid_requests(1) == 3
+        assert self._xid_requests(2) == 1
+
+    @raises(xcffib.XcffibException)
+    def test_live_ids_not_reused(self):
+        allocator = xcffib.resources.XidAllocator(self.conn)
+        allocator.generate_ids(16)
+        allocator.free(self.BASE | 4)
+        assert allocator.generate_ids(2) == [self.BASE | 4, self.BASE | 5]
+        # XC-MISC still lists 4 and 9, which were handed out but not created
+        allocator.generate_id()
+
+    def test_free_list_and_range(self):
+        self.conn.generate_ids(16)
+        self.ranges = [(0, 1), (self.BASE | 4, 3)]
+        allocator = xcffib.resources.XidAllocator(self.conn)
+        allocator.free(self.BASE | 6)
+        first = allocator.generate_ids(2)
+        assert first == [self.BASE | 6, self.BASE | 4]
+        # the rest of the range is 5 and 6, but 6 is in use
+        second = allocator.generate_ids(2)
+        assert second == [self.BASE | 5, self.BASE | 9]
+
+    def test_no_libxcb_after_exhaustion(self):
+        self.conn.generate_ids(16)
+        allocator = xcffib.resources.XidAllocator(self.conn)
+        allocator.generate_ids(2)
+        allocator.free(self.BASE | 5)
+        assert allocator.generate_id() == self.BASE | 5
+        # one GetXIDRange from libxcb and one from the allocator, which
+        # doesn't ask libxcb again
+        assert self._xid_requests(1) == 2
+
+    @raises(xcffib.XcffibException)
+    def test_out_of_ids(self):
+        allocator = xcffib.resources.XidAllocator(self.conn)
+        allocator.generate_ids(16)
+        allocator.generate_ids(5)
+
+
+def import_numpy():
+    try:
+        import numpy
+    except ImportError:
+        from nose.plugins.skip import SkipTest
+        raise SkipTest("numpy is not installed")
+    return numpy
+
+
+def test_lazy_screens():
+    visual = struct.pack("=IBBHIII4x", 0x21, 4, 8, 256, 0xff0000, 0xff00, 0xff)
+    depth = struct.pack("=BxH4x", 24, 2) + visual * 2
+    screen = struct.pack("=IIIIIHHHHHHIBBBB", 0x100, 0x20, 0xffffff, 0, 0,
+                         800, 600, 211, 158, 1, 1, 0x21, 0, 0, 24, 2) + \
+        depth * 2
+    data = screen * 2
+
+    unpacker = xcffib.Unpacker(ffi.new("char[]", data),
+                               lazy=xcffib._lazy_skips(True))
+    screens = xcffib.List(unpacker, xcffib.xproto.SCREEN, 2)
+    assert unpacker.offset == len(data)
+    assert screens._items == [xcffib._unloaded] * 2
+    depths = screens[1].allowed_depths
+    assert depths._offsets is not None
+    assert [v.visual_id for v in depths[1].visuals] == [0x21, 0x21]
+
+    eager = xcffib.List(xcffib.Unpacker(ffi.new("char[]", data)),
+                        xcffib.xproto.SCREEN, 2)
+    assert eager[1].width_in_pixels == screens[1].width_in_pixels == 800
+
+
+def test_pack_list_buffer():
+    import array
+    values = array.array('I', [1, 2, 3])
+    assert xcffib.pack_list(values, "I") == xcffib.pack_list([1, 2, 3], "I")
+    assert xcffib.pack_list(six.b("abc"), "c") == six.b("abc")
+
+    # floats aren't reinterpreted as integers
+    floats = array.array('f', [1.0])
+    assert xcffib._buffer_bytes(floats, "I") is None
+
+    # a List's wire data isn't sent once its items could have been changed
+    data = struct.pack("=III", 1, 2, 3)
+    lst = xcffib.List(xcffib.Unpacker(ffi.new("char[]", data)), "I", 3)
+    assert xcffib.pack_list(lst, "I") == data
+    lst.list[0] = 4
+    assert xcffib.pack_list(lst, "I") == struct.pack("=III", 4, 2, 3)
+
+
+def test_pack_list_byte_order():
+    numpy = import_numpy()
+    swapped = numpy.array([1, 2, 3], dtype=numpy.dtype('u4').newbyteorder())
+    assert xcffib._buffer_bytes(swapped, "I") is None
+    assert xcffib.pack_list(swapped, "I") == struct.pack("=III", 1, 2, 3)
+    native = numpy.array([1, 2, 3], dtype=numpy.dtype('=u4'))
+    assert xcffib._buffer_bytes(native, "I") == struct.pack("=III", 1, 2, 3)
+
+
+def test_synthetic_event():
+    event = xcffib.xproto.ConfigureNotifyEvent.synthetic(
+        event=1, window=2, above_sibling=0, x=-3, y=4, width=5, height=6,
+        border_width=0, override_redirect=False)
+    packed = event.pack()
+    assert len(packed) == 32
+    assert packed[0:1] == six.b(chr(22))
+
+    decoded = xcffib.xproto.ConfigureNotifyEvent(
+        xcffib.Unpacker(ffi.new("char[]", packed)))
+    assert (decoded.window, decoded.x, decoded.height) == (2, -3, 6)
+    assert decoded.pack() == packed
+
+
+class _Axis(xcffib.Struct):
+    _fields = ["Ii", ["resolution", "minimum"], []]
+
+
+class _Valuator(xcffib.Struct):
+    _fields = ["BxH", ["class_id", "axes_len"],
+               [["axes", _Axis, lambda s: s.axes_len],
+                ["name", "c", lambda s: 3]]]
+
+
+class _Data(xcffib.Union):
+    _fields = ["", [], [["data8", "B", lambda s: 8],
+                        ["data32", "I", lambda s: 2]]]
+
+
+def test_field_tables():
+    v = _Valuator.__new__(_Valuator)
+    v.class_id = 1
+    v.axes_len = 2
+    v.axes = []
+    for i in range(2):
+        axis = _Axis.__new__(_Axis)
+        axis.resolution, axis.minimum = i, -i
+        v.axes.append(axis)
+    v.name = [six.b("a"), six.b("b"), six.b("c")]
+    packed = v.pack()
+    assert len(packed) == 4 + 2 * 8 + 3
+
+    decoded = _Valuator(xcffib.Unpacker(ffi.new("char[]", packed)))
+    assert decoded.class_id == 1
+    assert [(a.resolution, a.minimum) for a in decoded.axes] == \
+        [(0, 0), (1, -1)]
+    assert decoded.name.to_string() == "abc"
+    assert decoded.bufsize == len(packed)
+
+    unpacker = xcffib.Unpacker(ffi.new("char[]", six.b("\x01") * 8))
+    data = _Data(unpacker)
+    assert list(data.data8) == [1] * 8
+    assert list(data.data32) == [0x01010101] * 2
+    assert unpacker.offset == 8
+
+    assert data.pack() == six.b("\x01") * 8
+    assert _Data.synthetic(data32=[1, 2]).pack() == struct.pack("=II", 1, 2)
+
+
+@raises(xcffib.XcffibException)
+def test_pack_without_table():
+    class Untabled(xcffib.Event):
+        pass
+    Untabled.synthetic(response_type=64).pack()